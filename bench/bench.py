@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of parse, convert, bank and write paths on synthetic corpora.
+
+    $ python bench/bench.py [--patterns N] [--save FILE] [--compare FILE]
+
+Each stage is timed separately for TB-3 and TB-03 corpora, and reported
+as patterns/sec with the peak memory traced during the stage. Output
+stages also report bytes of output per second.
+"""
+import argparse
+import json
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import tbconv  # noqa: E402
+
+
+def synthetic_text(machine, rng):
+    """Return the text of a random PRM file for machine.
+    """
+    length = rng.randrange(32 if machine == tbconv.Machine.TB3 else 16)
+    triplet = rng.randrange(2)
+    steps = [
+        (rng.randrange(13, 96), rng.randrange(2),
+         rng.randrange(2), rng.randrange(2))
+        for _ in range(32)
+    ]
+
+    if machine == tbconv.Machine.TB3:
+        lines = [
+            'TRIPLET({});'.format(triplet),
+            'LAST_STEP({});'.format(length),
+            'GATE_WIDTH(67);',
+        ]
+        lines.extend(
+            'STEP{}({},{},{},{});'.format(index + 1, *step)
+            for index, step in enumerate(steps))
+        lines.extend(['BANK(0);', 'PATCH(-1);'])
+    else:
+        lines = [
+            'END_STEP\t= {}'.format(length),
+            'TRIPLET\t= {}'.format(triplet),
+        ]
+        lines.extend(
+            'STEP {}\t= STATE={} NOTE={} ACCENT={} SLIDE={}'.format(
+                index + 1, step[2], step[0], step[3], step[1])
+            for index, step in enumerate(steps[:16]))
+    return '\n'.join(lines) + '\n'
+
+
+def corpus(machine, size, seed=0):
+    """Return a list of size synthetic texts for machine.
+    """
+    rng = random.Random(seed)
+    return [synthetic_text(machine, rng) for _ in range(size)]
+
+
+def measure(func, count, repeat=3):
+    """Return (patterns/sec, peak bytes, result) of func.
+
+    The rate is the best of repeat untraced runs, and the peak memory is
+    traced in one more run.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return count / best, peak, result
+
+
+def run(size, seed=0, repeat=3):
+    """Run every stage and return {'machine/stage': {'rate', 'peak'}}.
+    """
+    results = {}
+    for machine in (tbconv.Machine.TB3, tbconv.Machine.TB03):
+        texts = corpus(machine, size, seed)
+
+        rate, peak, patterns = measure(
+            lambda: [tbconv.Pattern.from_text(text) for text in texts],
+            size, repeat)
+        results['{}/parse'.format(machine.name)] = {
+            'rate': rate, 'peak': peak}
+
+        rate, peak, converted = measure(
+            lambda: [pattern.convert() for pattern in patterns],
+            size, repeat)
+        # bytes of output per pattern
+        average = sum(
+            len(text) for out_texts in converted for text in out_texts
+        ) / size
+        results['{}/convert'.format(machine.name)] = {
+            'rate': rate, 'peak': peak, 'bytes': rate * average}
+
+        if tbconv.load_numpy() is not None:
+            rate, peak, _ = measure(
+                lambda: tbconv.convert_bank(patterns), size, repeat)
+            results['{}/bank'.format(machine.name)] = {
+                'rate': rate, 'peak': peak, 'bytes': rate * average}
+
+        directory = tempfile.mkdtemp()
+        try:
+            def write():
+                for index, pattern in enumerate(patterns):
+                    output_file = os.path.join(
+                        directory, 'P{}.PRM'.format(index))
+                    out_lines = pattern.convert_lines()
+                    tbconv.write_outputs(zip(
+                        tbconv.output_names(output_file, len(out_lines)),
+                        out_lines))
+
+            rate, peak, _ = measure(write, size, repeat)
+        finally:
+            shutil.rmtree(directory)
+        results['{}/write'.format(machine.name)] = {
+            'rate': rate, 'peak': peak, 'bytes': rate * average}
+
+    return results
+
+
+def report(results, baseline=None, tolerance=0.2):
+    """Print results, compared with baseline if given.
+
+    Return the names of stages slower than baseline beyond tolerance.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        line = '{:<14} {:>12,.0f} patterns/s {:>10,.0f} KiB peak'.format(
+            name, result['rate'], result['peak'] / 1024)
+        if 'bytes' in result:
+            line += ' {:>8.1f} MB/s'.format(result['bytes'] / 1e6)
+        else:
+            line += ' ' * 13
+        if baseline and name in baseline:
+            ratio = result['rate'] / baseline[name]['rate']
+            line += '  {:>6.2f}x'.format(ratio)
+            if ratio < 1 - tolerance:
+                line += '  REGRESSION'
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-n', '--patterns',
+        type=int,
+        default=10000,
+        help='Number of patterns in each corpus. (default: 10000)',
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='Random seed of corpora. (default: 0)',
+    )
+    parser.add_argument(
+        '-r', '--repeat',
+        type=int,
+        default=3,
+        help='Number of timed runs of each stage. (default: 3)',
+    )
+    parser.add_argument(
+        '--save',
+        help='Save results as a baseline JSON file.',
+    )
+    parser.add_argument(
+        '--compare',
+        help='Compare results with a baseline JSON file.',
+    )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.2,
+        help='Allowed slowdown against the baseline. (default: 0.2)',
+    )
+    args = parser.parse_args()
+
+    results = run(args.patterns, args.seed, args.repeat)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'rt') as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline, args.tolerance)
+
+    if args.save:
+        with open(args.save, 'wt') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmark of parsing the files in samples/.
+
+    $ python bench/bench_parse.py [--repeat N]
+
+Lines are parsed one by one with read_param(), and files at once with
+Pattern.from_text().
+"""
+import argparse
+import os.path
+import sys
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import tbconv  # noqa: E402
+
+
+def load_lines():
+    """Load lines of sample files with their machine types.
+    """
+    samples = os.path.join(ROOT, 'samples')
+    lines = []
+    for name in sorted(os.listdir(samples)):
+        with open(os.path.join(samples, name), 'rt') as prm:
+            file_lines = prm.readlines()
+        machine = tbconv.get_machine_type(file_lines[0])
+        lines.extend((line, machine) for line in file_lines)
+    return lines
+
+
+def load_texts():
+    """Load texts of sample files.
+    """
+    samples = os.path.join(ROOT, 'samples')
+    texts = []
+    for name in sorted(os.listdir(samples)):
+        with open(os.path.join(samples, name), 'rt') as prm:
+            texts.append(prm.read())
+    return texts
+
+
+def run(lines):
+    note = [24] * 32
+    state = [0] * 32
+    slide = [0] * 32
+    accent = [0] * 32
+    for line, machine in lines:
+        tbconv.read_param(
+            line, machine, 16, 0, note, state, slide, accent)
+
+
+def run_files(texts):
+    for text in texts:
+        tbconv.Pattern.from_text(text)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    lines = load_lines()
+    best = min(timeit.repeat(
+        lambda: run(lines), number=args.repeat, repeat=5))
+    print('{} lines x {}: {:.3f} s, {:,.0f} lines/s'.format(
+        len(lines), args.repeat, best, len(lines) * args.repeat / best))
+
+    texts = load_texts()
+    best = min(timeit.repeat(
+        lambda: run_files(texts), number=args.repeat, repeat=5))
+    print('{} files x {}: {:.3f} s, {:,.0f} files/s'.format(
+        len(texts), args.repeat, best, len(texts) * args.repeat / best))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Load test of "tbconv.py serve" from localhost.
+
+    $ python tbconv.py serve --port 8080 &
+    $ python bench/load_serve.py [--port 8080] [--requests N] [--clients C]
+
+Each client keeps one connection and posts the files in samples/ in turn.
+Latency of every request is reported as p50/p99.
+"""
+import argparse
+import asyncio
+import os.path
+import statistics
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def load_payloads():
+    """Return (name, bytes) of sample files.
+    """
+    samples = os.path.join(ROOT, 'samples')
+    payloads = []
+    for name in sorted(os.listdir(samples)):
+        with open(os.path.join(samples, name), 'rb') as prm:
+            payloads.append((name, prm.read()))
+    return payloads
+
+
+async def post(reader, writer, host, name, body):
+    """Post one conversion request and return the status code.
+    """
+    writer.write((
+        'POST /convert?name={} HTTP/1.1\r\n'
+        'Host: {}\r\n'
+        'Content-Length: {}\r\n'
+        '\r\n'
+    ).format(name, host, len(body)).encode('latin-1') + body)
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        if key.strip().lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def client(host, port, path, payloads, count, latencies):
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for index in range(count):
+            name, body = payloads[index % len(payloads)]
+            start = time.perf_counter()
+            status = await post(reader, writer, host, name, body)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                raise RuntimeError('HTTP {} for {}'.format(status, name))
+    finally:
+        writer.close()
+
+
+async def run(host, port, path, requests, clients):
+    payloads = load_payloads()
+    latencies = []
+    per_client = max(1, requests // clients)
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        client(host, port, path, payloads, per_client, latencies)
+        for _ in range(clients)
+    ])
+    return time.perf_counter() - start, latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', default=None)
+    parser.add_argument('-n', '--requests', type=int, default=10000)
+    parser.add_argument('-c', '--clients', type=int, default=16)
+    args = parser.parse_args()
+
+    elapsed, latencies = asyncio.run(run(
+        args.host, args.port, args.unix, args.requests, args.clients))
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    print('{} requests in {:.2f} s, {:,.0f} requests/s'.format(
+        len(latencies), elapsed, len(latencies) / elapsed))
+    print('p50 {:.2f} ms, p99 {:.2f} ms'.format(
+        quantiles[49] * 1000, quantiles[98] * 1000))
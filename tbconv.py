@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
-import argparse
+# Only modules needed to convert one file are imported here. Others are
+# imported where they are used, to keep start-up of the CLI fast.
+import collections
 import enum
-import re
+import functools
+import itertools
 import os.path
+import struct
+import sys
 
+# NumPy is imported by load_numpy() on first use
+numpy = NotImplemented
+
+
+__version__ = '0.1.0'
 
 VERBOSE = False
 
@@ -41,153 +51,305 @@ def get_machine_type(line):
         return Machine.UNKNOWN
 
 
+class _Lookup(dict):
+    """Memoized conversion of decimal strings, cheaper than calling int().
+
+    Only the first max_keys distinct strings are kept, so that memory does
+    not grow with untrusted input, and others are converted on each call.
+    """
+    def __init__(self, func, max_keys=1024):
+        self.func = func
+        self.max_keys = max_keys
+
+    def __missing__(self, key):
+        value = self.func(key)
+        if len(self) < self.max_keys:
+            self[key] = value
+        return value
+
+
+INTS = _Lookup(int)
+# invert the value of step for TB-3
+INVERTED = _Lookup(lambda key: int(not int(key)))
+
+
+def _last_value(line):
+    # value of END_STEP\t= n, LAST_STEP(n);, TRIPLET(n); and TRIPLET\t= n
+    return line.strip(');\r\n').replace('(', ' ').replace('=', ' ')\
+        .split()[-1]
+
+
 def read_param(line, machine, length=16, triplet=0,
                note=[], state=[], slide=[], accent=[]):
     """Read one line and parse parameters.
     """
-    if line.startswith('END_'):
-        length = int(re.split(r'[\(\t= ]', line.strip(');\n'))[-1])
-
-    elif line.startswith('LAST'):
-        length = int(re.split(r'[\(\t= ]', line.strip(');\n'))[-1])
-
-    elif line.startswith('TRIPLET'):
-        triplet = int(re.split(r'[\(\t= ]', line.strip(');\n'))[-1])
-
-    elif line.startswith('STEP '):
-        step = line.replace('STEP ', '')\
-                   .replace('\t= STATE=', ',')\
-                   .replace(' NOTE=', ',')\
-                   .replace(' ACCENT=', ',')\
-                   .replace(' SLIDE=', ',')\
-                   .replace('\n', '')\
-                   .split(',')
-        index = int(step[0])
-        # invert the value of step for TB-3
-        state[index-1] = int(not(int(step[1])))
-        note[index-1] = int(step[2])
-        accent[index-1] = int(step[3])
-        slide[index-1] = int(step[4])
-
-    elif line.startswith('STEP'):
-        step = line.replace('STEP', '')\
-                   .replace('(', ',')\
-                   .strip(');\n')\
-                   .split(',')
-        index = int(step[0])
-        note[index-1] = int(step[1])
-        slide[index-1] = int(step[2])
-        # invert the value of step for TB-3
-        state[index-1] = int(not(int(step[3])))
-        accent[index-1] = int(step[4])
+    return read_params(
+        (line,), machine, length, triplet, note, state, slide, accent)
+
+
+def read_params(lines, machine, length=16, triplet=0,
+                note=[], state=[], slide=[], accent=[]):
+    """Read all lines and parse parameters.
+
+    The lines are dispatched in one loop, without a function call per line.
+    Raise ValueError for a step out of the range of note.
+    """
+    ints = INTS
+    inverted = INVERTED
+    steps = len(note)
+    for line in lines:
+        if line.startswith('STEP '):
+            # STEP n\t= STATE=s NOTE=n ACCENT=a SLIDE=s
+            _, index, _, st, n, ac, sl = line.split()
+            index = ints[index] - 1
+            if not 0 <= index < steps:
+                raise ValueError('Invalid step {}.'.format(index + 1))
+            state[index] = inverted[st[6:]]
+            note[index] = ints[n[5:]]
+            accent[index] = ints[ac[7:]]
+            slide[index] = ints[sl[6:]]
+
+        elif line.startswith('STEP'):
+            # STEPn(note,slide,state,accent);
+            index, n, sl, st, ac = line[4:line.index(')')]\
+                .replace('(', ',').split(',')
+            index = ints[index] - 1
+            if not 0 <= index < steps:
+                raise ValueError('Invalid step {}.'.format(index + 1))
+            note[index] = ints[n]
+            slide[index] = ints[sl]
+            state[index] = inverted[st]
+            accent[index] = ints[ac]
+
+        elif line.startswith(('END_', 'LAST')):
+            length = ints[_last_value(line)]
+
+        elif line.startswith('TRIPLET'):
+            triplet = ints[_last_value(line)]
 
     return length, triplet, note, state, slide, accent
 
 
-def write_params(machine, output_file, length, triplet,
-                 note, state, slide, accent):
-    """Write pattern to output_file.
+class _StepLines(dict):
+    """Lines of steps keyed by a tuple of their values.
+
+    Lines for notes 0-255 with flags 0/1 are formatted in advance, and
+    others are formatted on demand without being stored.
     """
-    if machine == Machine.TB3:
-        out_lines_1 = []
-        out_lines_2 = []
+    def __init__(self, template, flags):
+        self.template = template
+        for note in range(256):
+            for values in itertools.product((0, 1), repeat=flags):
+                key = (note,) + values
+                self[key] = template.format(*key)
+
+    def __missing__(self, key):
+        return self.template.format(*key)
+
+
+@functools.lru_cache(maxsize=None)
+def step_tables():
+    """Return prefixes and lines of steps of TB-03 and TB-3 files.
+
+    Lines of TB-03 are keyed by (note, state, accent, slide), and those
+    of TB-3 by (note, slide, state, accent).
+    """
+    return (
+        ['STEP {}'.format(index % 16 + 1) for index in range(32)],
+        _StepLines('\t= STATE={1} NOTE={0} ACCENT={2} SLIDE={3}\n', 3),
+        ['STEP{}'.format(index + 1) for index in range(32)],
+        _StepLines('({},{},{},{});\n', 3),
+    )
+
+
+# steps of a TB-03 pattern, into which longer patterns are split
+CHUNK_STEPS = 16
 
-        # END_STEP
-        if length < 16:
-            out_lines_1.append('END_STEP\t= {}'.format(length))
-            output_file1 = output_file
+
+def chunk_count(length, steps=32):
+    """Return the number of TB-03 patterns for a pattern of length, where
+    the pattern has steps at most.
+    """
+    return max(1, min(length // CHUNK_STEPS + 1, steps // CHUNK_STEPS))
+
+
+def tb03_lines(length, triplet, note, state, slide, accent, chunk=0):
+    """Return an iterator of lines of the chunk-th TB-03 file of pattern.
+    """
+    prefixes, lines, _, _ = step_tables()
+    start = chunk * CHUNK_STEPS
+    end_step = min(length - start, CHUNK_STEPS - 1)
+    steps = slice(start, start + CHUNK_STEPS)
+
+    return itertools.chain(
+        ('END_STEP\t= {}\nTRIPLET\t= {}\n'.format(end_step, triplet),),
+        itertools.chain.from_iterable(zip(
+            prefixes,
+            map(lines.__getitem__, zip(
+                note[steps], state[steps], accent[steps], slide[steps])),
+        )),
+    )
+
+
+def tb3_lines(length, triplet, note, state, slide, accent):
+    """Return an iterator of lines of a TB-3 file of pattern.
+    """
+    _, _, prefixes, lines = step_tables()
+    return itertools.chain(
+        ('TRIPLET({});\nLAST_STEP({});\nGATE_WIDTH(67);\n'.format(
+            triplet, length),),
+        itertools.chain.from_iterable(zip(
+            prefixes,
+            map(lines.__getitem__, zip(note, slide, state, accent)),
+        )),
+        ('BANK(0);\nPATCH(-1);\n',),
+    )
+
+
+def tb03_texts(length, triplet, note, state, slide, accent):
+    """Format pattern as TB-03 file(s).
+
+    Return a text for each 16 steps of the pattern.
+    """
+    params = (length, triplet, note, state, slide, accent)
+    return [
+        ''.join(tb03_lines(*params, chunk=chunk))
+        for chunk in range(chunk_count(length, len(note)))
+    ]
+
+
+def tb3_text(length, triplet, note, state, slide, accent):
+    """Format pattern as a TB-3 file.
+    """
+    return ''.join(tb3_lines(length, triplet, note, state, slide, accent))
+
+
+class Naming(object):
+    """Naming strategy of files a pattern is split into.
+
+    template is formatted with root and ext of the output file, and with
+    letter (a, b, ...) and number (1, 2, ...) of each file.
+    """
+    LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+    def __init__(self, template='{root}{letter}{ext}'):
+        self.template = template
+        self._regex = None
+
+    def names(self, output_file, count):
+        """Return names of count output files for output_file.
+        """
+        if count == 1:
+            return [output_file]
+
+        root, ext = os.path.splitext(output_file)
+        return [
+            self.template.format(
+                root=root, ext=ext,
+                letter=self.LETTERS[index], number=index + 1)
+            for index in range(count)
+        ]
+
+    def parse(self, name):
+        """Return (output_file, index) of a name given by names(), or None.
+        """
+        if self._regex is None:
+            import re
+
+            fields = {
+                'root': r'(?P<root>.+?)',
+                'ext': r'(?P<ext>\.[^./\\]*)?',
+                'letter': r'(?P<letter>[a-z])',
+                'number': r'(?P<number>[1-9]\d*)',
+            }
+            pattern = re.sub(
+                r'\\{(\w+)\\}', lambda m: fields[m.group(1)],
+                re.escape(self.template))
+            self._regex = re.compile(pattern, re.IGNORECASE)
+
+        match = self._regex.fullmatch(name)
+        if match is None:
+            return None
+        fields = match.groupdict()
+        ext = fields.get('ext') or ''
+        # the extension must be the one names() would have split
+        if ext != os.path.splitext(name)[1]:
+            return None
+
+        if fields.get('letter') is not None:
+            index = self.LETTERS.index(fields['letter'].lower())
         else:
-            out_lines_1.append('END_STEP\t= 15')
-
-            # output_file name
-            ofn = output_file.split('.')
-            # TODO: check no '.'
-            output_file1 = '{}a.{}'.format(ofn[0], ofn[1])
-            output_file2 = '{}b.{}'.format(ofn[0], ofn[1])
-
-        out_lines_2.append('END_STEP\t= {}'.format(length - 16))
-
-        # TRIPLET
-        out_lines_1.append('TRIPLET\t= {}'.format(triplet))
-        out_lines_2.append('TRIPLET\t= {}'.format(triplet))
-
-        # STEPs
-        for index in range(16):
-            out_lines_1.append(
-                'STEP {}\t= STATE={} NOTE={} ACCENT={} SLIDE={}'.format(
-                    index + 1,
-                    state[index],
-                    note[index],
-                    accent[index],
-                    slide[index],
-                ))
-        for index in range(16, 32):
-            out_lines_2.append(
-                'STEP {}\t= STATE={} NOTE={} ACCENT={} SLIDE={}'.format(
-                    index - 15,
-                    state[index],
-                    note[index],
-                    accent[index],
-                    slide[index],
-                ))
-
-        out_text1 = '\n'.join(out_lines_1) + '\n'
-        with open(output_file1, 'wt') as outf:
-            outf.write(out_text1)
-            vprint([
-                '',
-                '----------',
-                'Output file: {}'.format(output_file1),
-                '----------',
-                '',
-                out_text1,
-            ])
+            index = int(fields['number']) - 1
+        return fields['root'] + ext, index
 
-        if length > 15:
-            out_text2 = '\n'.join(out_lines_2) + '\n'
-            with open(output_file2, 'wt') as outf:
-                outf.write(out_text2)
 
-            vprint([
-                '----------',
-                'Output file: {}'.format(output_file2),
-                '----------',
-                '',
-                out_text2,
-                '----------',
-                '',
-            ])
+def output_names(output_file, count, naming=Naming()):
+    """Return names of count output files for output_file.
+    """
+    return naming.names(output_file, count)
 
-            print((
-                '{} and {} are generated instead of {}, '
-                'because the pattern in input file is longer than 16 steps.\n'
-            ).format(
-                output_file1, output_file2, output_file,
-            ))
 
-    elif machine == Machine.TB03:
-        out_lines = []
-        out_lines.append('TRIPLET({});'.format(triplet))
-        out_lines.append('LAST_STEP({});'.format(length))
-        out_lines.append('GATE_WIDTH(67);')
-
-        for index in range(32):
-            out_lines.append(
-                'STEP{}({},{},{},{});'.format(
-                    index+1,
-                    note[index],
-                    slide[index],
-                    state[index],
-                    accent[index],
-                ))
-
-        out_lines.append('BANK(0);')
-        out_lines.append('PATCH(-1);')
-
-        out_text = '\n'.join(out_lines) + '\n'
-        with open(output_file, 'wt') as outf:
-            outf.write(out_text)
+# fsync output files before they are renamed, set by --fsync
+FSYNC = False
+
+
+def write_file(output_file, text):
+    """Write text to output_file atomically, unless the file already has
+    the same content.
 
+    text is written to a temporary file renamed to output_file, which is
+    fsynced before renamed if FSYNC is set. Return True if written.
+    """
+    data = text if os.linesep == '\n' else text.replace('\n', os.linesep)
+    try:
+        if os.path.getsize(output_file) == len(data):
+            with open(output_file, 'rt', newline='') as current:
+                if current.read() == data:
+                    return False
+    except (OSError, UnicodeDecodeError):
+        pass
+
+    temp = '{}.{}.tmp'.format(output_file, os.getpid())
+    try:
+        with open(temp, 'wt') as outf:
+            outf.write(text)
+            if FSYNC:
+                outf.flush()
+                os.fsync(outf.fileno())
+        os.replace(temp, output_file)
+    except BaseException:
+        _remove(temp)
+        raise
+    return True
+
+
+def sync_directories(paths):
+    """fsync the directory of each of paths once, so that files renamed
+    into them are durable.
+    """
+    for directory in set(
+            os.path.dirname(os.path.abspath(path)) for path in paths):
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def write_outputs(outputs):
+    """Write (output_file, text) pairs with write_file().
+
+    text may also be an iterable of lines. Return the list of output
+    files, including those left as they were.
+    """
+    written = []
+    for output_file, out_text in outputs:
+        if not isinstance(out_text, str):
+            out_text = ''.join(out_text)
+        write_file(output_file, out_text)
+        written.append(output_file)
+
+        if VERBOSE:
             vprint([
                 '',
                 '----------',
@@ -195,90 +357,3481 @@ def write_params(machine, output_file, length, triplet,
                 '----------',
                 '',
                 out_text,
-                '----------',
-
             ])
 
+    return written
 
-def main(input_file, output_file):
-    if not(os.path.exists(input_file)):
-        print('No such file: {}'.format(input_file))
-        return
 
-    with open(input_file, "rt") as prm:
-        line = prm.readline()
-        machine = get_machine_type(line)
+def print_split(output_file, written):
+    """Notify that output_file is split into several files.
+    """
+    if len(written) > 1:
+        print((
+            '{} are generated instead of {}, '
+            'because the pattern in input file is longer than 16 steps.\n'
+        ).format(
+            ' and '.join(written), output_file,
+        ))
+
 
-        if machine == Machine.UNKNOWN:
-            print('Invalid file type.')
-            exit()
+def write_params(machine, output_file, length, triplet,
+                 note, state, slide, accent):
+    """Write pattern to output_file.
 
-        convert_to = Machine.TB03 if machine == Machine.TB3 else Machine.TB3
-        print('Converting backup file from {} to {}\n'.format(
-            machine.name, convert_to.name))
+    Return the list of written files.
+    """
+    if machine == Machine.TB3:
+        out_texts = tb03_texts(length, triplet, note, state, slide, accent)
+    elif machine == Machine.TB03:
+        out_texts = [tb3_text(length, triplet, note, state, slide, accent)]
+    else:
+        return []
 
-        length = 16
-        triplet = 0
-        note = [
-            24, 24, 24, 24, 24, 24, 24, 24, 24, 24, 24, 24, 24, 24, 24, 24,
-            24, 24, 24, 24, 24, 24, 24, 24, 24, 24, 24, 24, 24, 24, 24, 24,
-        ]
-        state = [
-            0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
-        ]
-        slide = [
-            0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
-        ]
-        accent = [
-            0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
-            0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
-        ]
-        length, triplet, note, state, slide, accent = read_param(
-            line, machine, length, triplet, note, state, slide, accent)
+    written = write_outputs(
+        zip(output_names(output_file, len(out_texts)), out_texts))
+    print_split(output_file, written)
 
-        vprint([
-            '----------',
-            'Input File: {}'.format(input_file),
-            '----------',
-            '',
-        ])
+    return written
 
-        while True:
-            line = prm.readline()
-            vprint([line], end='')
-            length, triplet, note, state, slide, accent = read_param(
-                line, machine, length, triplet, note, state, slide, accent)
-            if not line:
-                break
 
-        write_params(
-            machine, output_file, length, triplet, note, state, slide, accent)
+def read_text(input_file):
+    """Return the text of input_file.
+    """
+    with open(input_file, 'rt') as prm:
+        return prm.read()
 
-    print('Conversion complete.')
 
+class Pattern(object):
+    """Pattern of TB-3/TB-03.
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        'INPUT_FILE',
-        help='File to convert.',
-    )
-    parser.add_argument(
-        'OUTPUT_FILE',
-        help='The result of file conversion.',
+    Steps are packed into one bytearray holding the note, state, slide and
+    accent planes, STEPS bytes each. As read_params() does, state is
+    inverted from the value in the file of the source machine.
+    """
+    __slots__ = ('machine', 'length', 'triplet', 'steps')
+
+    STEPS = 32
+    DEFAULT_STEPS = bytes([24] * STEPS + [0] * STEPS * 3)
+
+    def __init__(self, machine, length=16, triplet=0, steps=None):
+        self.machine = machine
+        self.length = length
+        self.triplet = triplet
+        self.steps = bytearray(
+            self.DEFAULT_STEPS if steps is None else steps)
+
+    def __eq__(self, other):
+        if not isinstance(other, Pattern):
+            return NotImplemented
+        return (
+            self.machine == other.machine
+            and self.length == other.length
+            and self.triplet == other.triplet
+            and self.steps == other.steps
+        )
+
+    def __repr__(self):
+        return 'Pattern({}, length={}, triplet={})'.format(
+            self.machine.name, self.length, self.triplet)
+
+    def _plane(self, index):
+        return memoryview(self.steps)[
+            index * self.STEPS:(index + 1) * self.STEPS]
+
+    @property
+    def note(self):
+        return self._plane(0)
+
+    @property
+    def state(self):
+        return self._plane(1)
+
+    @property
+    def slide(self):
+        return self._plane(2)
+
+    @property
+    def accent(self):
+        return self._plane(3)
+
+    def params(self):
+        """Return parameters in the order of write_params().
+        """
+        return (
+            self.length, self.triplet,
+            self.note, self.state, self.slide, self.accent,
+        )
+
+    @classmethod
+    def from_lines(cls, lines, machine=None):
+        """Read a pattern from lines of a PRM file.
+
+        The machine type is detected from the first line unless given.
+        """
+        if not isinstance(lines, list):
+            lines = list(lines)
+        if machine is None:
+            machine = get_machine_type(lines[0] if lines else '')
+            if machine == Machine.UNKNOWN:
+                raise ValueError('Invalid file type.')
+
+        pattern = cls(machine)
+        pattern.length, pattern.triplet, _, _, _, _ = read_params(
+            lines, machine, *pattern.params())
+        return pattern
+
+    @classmethod
+    def from_text(cls, text, machine=None):
+        """Read a pattern from the text of a PRM file.
+        """
+        return cls.from_lines(text.splitlines(), machine)
+
+    @classmethod
+    def from_buffer(cls, buffer, machine=None, encoding='ascii'):
+        """Read a pattern from bytes-like buffer of a PRM file.
+        """
+        return cls.from_text(str(buffer, encoding), machine)
+
+    def _params_for(self, machine):
+        # state is inverted only when written back to the source machine
+        if machine != self.machine:
+            return self.params()
+        state = bytes(1 - s if s in (0, 1) else 0 for s in self.state)
+        return (
+            self.length, self.triplet,
+            self.note, state, self.slide, self.accent,
+        )
+
+    def split(self):
+        """Return patterns of each 16 steps, as written to TB-03 files.
+        """
+        patterns = []
+        for chunk in range(chunk_count(self.length, self.STEPS)):
+            start = chunk * CHUNK_STEPS
+            pattern = Pattern(
+                self.machine, min(self.length - start, CHUNK_STEPS - 1),
+                self.triplet)
+            for plane in range(4):
+                pattern._plane(plane)[:CHUNK_STEPS] = \
+                    self._plane(plane)[start:start + CHUNK_STEPS]
+            patterns.append(pattern)
+        return patterns
+
+    @classmethod
+    def merge(cls, patterns):
+        """Return one pattern of patterns of each 16 steps, as split() was
+        called for it.
+        """
+        if not patterns or len(patterns) * CHUNK_STEPS > cls.STEPS:
+            raise ValueError(
+                'Cannot merge {} patterns.'.format(len(patterns)))
+
+        merged = cls(
+            patterns[0].machine,
+            (len(patterns) - 1) * CHUNK_STEPS + patterns[-1].length,
+            patterns[0].triplet)
+        for chunk, pattern in enumerate(patterns):
+            start = chunk * CHUNK_STEPS
+            for plane in range(4):
+                merged._plane(plane)[start:start + CHUNK_STEPS] = \
+                    pattern._plane(plane)[:CHUNK_STEPS]
+        return merged
+
+    def to_tb3(self):
+        """Return the text of a TB-3 file.
+        """
+        return tb3_text(*self._params_for(Machine.TB3))
+
+    def convert_lines(self):
+        """Return iterators of lines of file(s) for the other machine.
+        """
+        if self.machine == Machine.TB3:
+            params = self._params_for(Machine.TB03)
+            return [
+                tb03_lines(*params, chunk=chunk)
+                for chunk in range(chunk_count(self.length, self.STEPS))
+            ]
+        return [tb3_lines(*self._params_for(Machine.TB3))]
+
+    def to_tb03(self):
+        """Return the text(s) of TB-03 file(s).
+
+        A text is returned for each 16 steps of the pattern.
+        """
+        return tb03_texts(*self._params_for(Machine.TB03))
+
+    def convert(self):
+        """Return the text(s) converted for the other machine.
+        """
+        if self.machine == Machine.TB3:
+            return self.to_tb03()
+        return [self.to_tb3()]
+
+    def used_steps(self):
+        """Return note, state, slide and accent of steps up to the last
+        step, with state as written in TB-03 files.
+        """
+        count = max(0, min(self.length + 1, self.STEPS))
+        return tuple(
+            bytes(plane[:count])
+            for plane in self._params_for(Machine.TB03)[2:])
+
+    def fingerprint(self):
+        """Return a hex digest of the canonical form of the pattern.
+
+        Patterns of either machine with the same triplet and used steps
+        have the same fingerprint, whatever follows the last step.
+        """
+        import hashlib
+
+        planes = self.used_steps()
+        digest = hashlib.sha256('{} {}\n'.format(
+            len(planes[0]), int(bool(self.triplet))).encode('ascii'))
+        for plane in planes:
+            digest.update(plane)
+        return digest.hexdigest()
+
+
+def load_numpy():
+    """Import NumPy on first use, or return None if it is not installed.
+    """
+    global numpy
+    if numpy is NotImplemented:
+        try:
+            import numpy as module
+        except ImportError:  # pragma: no cover
+            module = None
+        numpy = module
+    return numpy
+
+
+def _byte_table(texts):
+    """Return a (len(texts), width) uint8 array of ASCII texts, padded with
+    NUL bytes to the width of the longest one.
+    """
+    data = [text.encode('ascii') for text in texts]
+    width = max(map(len, data))
+    return numpy.frombuffer(
+        b''.join(item.ljust(width, b'\0') for item in data),
+        dtype=numpy.uint8).reshape(len(data), width)
+
+
+@functools.lru_cache(maxsize=None)
+def _bank_tables():
+    """Return byte tables of headers, step prefixes, step lines indexed by
+    step code and the footer, of TB-03 and TB-3 files.
+
+    Headers are indexed by END_STEP/LAST_STEP * 2 + TRIPLET, and step
+    codes are ((note * 2 + state) * 2 + accent) * 2 + slide.
+    """
+    codes = list(itertools.product(range(256), (0, 1), (0, 1), (0, 1)))
+    return (
+        _byte_table([
+            'END_STEP\t= {}\nTRIPLET\t= {}\n'.format(end_step, triplet)
+            for end_step in range(CHUNK_STEPS) for triplet in (0, 1)]),
+        _byte_table(
+            ['STEP {}'.format(index + 1) for index in range(CHUNK_STEPS)]),
+        _byte_table([
+            '\t= STATE={} NOTE={} ACCENT={} SLIDE={}\n'.format(
+                state, note, accent, slide)
+            for note, state, accent, slide in codes]),
+        _byte_table([
+            'TRIPLET({});\nLAST_STEP({});\nGATE_WIDTH(67);\n'.format(
+                triplet, length)
+            for length in range(Pattern.STEPS) for triplet in (0, 1)]),
+        _byte_table(
+            ['STEP{}'.format(index + 1) for index in range(Pattern.STEPS)]),
+        _byte_table([
+            '({},{},{},{});\n'.format(note, slide, state, accent)
+            for note, state, accent, slide in codes]),
+        _byte_table(['BANK(0);\nPATCH(-1);\n']),
     )
-    parser.add_argument(
-        '-p', '--print',
-        action='store_true',
-        dest='verbose',
-        help='Print input and output file.',
+
+
+def bank_array(patterns):
+    """Return a (N, 32, 4) uint8 array of note, state, slide and accent.
+    """
+    load_numpy()
+    steps = numpy.frombuffer(
+        b''.join(pattern.steps for pattern in patterns), dtype=numpy.uint8)
+    return steps.reshape(len(patterns), 4, Pattern.STEPS).transpose(0, 2, 1)
+
+
+def _join_rows(rows):
+    # texts of (M, width) uint8 rows, without their NUL padding
+    present = rows != 0
+    data = rows[present].tobytes().decode('ascii')
+    ends = numpy.cumsum(present.sum(axis=1)).tolist()
+    return [data[start:end] for start, end in zip([0] + ends, ends)]
+
+
+def _convert_bank(steps, length, triplet, machine):
+    # steps, length and triplet of patterns from machine, whose flags are
+    # 0 or 1, length is less than Pattern.STEPS and triplet is 0 or 1
+    (tb03_header, tb03_prefix, tb03_body,
+     tb3_header, tb3_prefix, tb3_body, tb3_footer) = _bank_tables()
+
+    steps = steps.astype(numpy.intp)
+    note, state, slide, accent = numpy.moveaxis(steps, 2, 0)
+    code = ((note * 2 + state) * 2 + accent) * 2 + slide
+    count = len(code)
+
+    if machine == Machine.TB3:
+        chunks = numpy.minimum(
+            length // CHUNK_STEPS + 1, Pattern.STEPS // CHUNK_STEPS)
+        index = numpy.repeat(numpy.arange(count), chunks)
+        ends = numpy.cumsum(chunks)
+        chunk = numpy.arange(len(index)) - numpy.repeat(ends - chunks, chunks)
+        end_step = numpy.minimum(
+            length[index] - chunk * CHUNK_STEPS, CHUNK_STEPS - 1)
+
+        code = code.reshape(count, -1, CHUNK_STEPS)[index, chunk]
+        lines = numpy.concatenate([
+            numpy.broadcast_to(
+                tb03_prefix, code.shape + tb03_prefix.shape[1:]),
+            tb03_body[code],
+        ], axis=2)
+        texts = _join_rows(numpy.concatenate([
+            tb03_header[end_step * 2 + triplet[index]],
+            lines.reshape(len(index), -1),
+        ], axis=1))
+        ends = ends.tolist()
+        return [
+            texts[start:end] for start, end in zip([0] + ends, ends)]
+
+    lines = numpy.concatenate([
+        numpy.broadcast_to(tb3_prefix, code.shape + tb3_prefix.shape[1:]),
+        tb3_body[code],
+    ], axis=2)
+    texts = _join_rows(numpy.concatenate([
+        tb3_header[length * 2 + triplet],
+        lines.reshape(count, -1),
+        numpy.broadcast_to(tb3_footer, (count, tb3_footer.shape[1])),
+    ], axis=1))
+    return [[text] for text in texts]
+
+
+def convert_bank(patterns):
+    """Convert a bank of patterns at once with NumPy.
+
+    Return a list of texts for each pattern as Pattern.convert() does.
+    Patterns NumPy cannot handle, or all of them if NumPy is not
+    installed, are converted one by one.
+    """
+    results = [None] * len(patterns)
+    if load_numpy() is None:
+        return [pattern.convert() for pattern in patterns]
+
+    for machine in (Machine.TB3, Machine.TB03):
+        indices = [
+            index for index, pattern in enumerate(patterns)
+            if pattern.machine == machine]
+        if not indices:
+            continue
+        bank = [patterns[index] for index in indices]
+        steps = bank_array(bank)
+        length = numpy.fromiter(
+            (pattern.length for pattern in bank), numpy.intp, len(bank))
+        triplet = numpy.fromiter(
+            (pattern.triplet for pattern in bank), numpy.intp, len(bank))
+        supported = (
+            (steps[:, :, 1:] <= 1).all(axis=(1, 2))
+            & (length >= 0) & (length < Pattern.STEPS)
+            & ((triplet == 0) | (triplet == 1)))
+
+        selected = numpy.flatnonzero(supported)
+        if not len(selected):
+            continue
+        texts = _convert_bank(
+            steps[selected], length[selected], triplet[selected], machine)
+        for position, out_texts in zip(selected.tolist(), texts):
+            results[indices[position]] = out_texts
+
+    for index, pattern in enumerate(patterns):
+        if results[index] is None:
+            results[index] = pattern.convert()
+    return results
+
+
+class ConversionCache(object):
+    """Cache of converted texts keyed by a hash of the input text.
+
+    Recently used entries are kept in memory up to maxsize entries, and
+    also stored in directory, if given, up to max_bytes in total. Entries
+    on disk are evicted in order of their mtime, which is updated on hit.
+    """
+    def __init__(self, maxsize=1024, directory=None,
+                 max_bytes=64 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._disk_bytes = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(text):
+        """Return the cache key of text.
+        """
+        import hashlib
+
+        return hashlib.sha256(
+            '{}\0{}'.format(__version__, text).encode('utf-8')).hexdigest()
+
+    def _remember(self, key, texts):
+        self.memory[key] = texts
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        """Return cached texts of key, or None.
+        """
+        texts = self.memory.get(key)
+        if texts is not None:
+            self.memory.move_to_end(key)
+            return texts
+        if self.directory is None:
+            return None
+
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, 'rt') as cached:
+                texts = tuple(cached.read().split(STREAM_DELIMITER + '\n'))
+            os.utime(path)
+        except OSError:
+            return None
+
+        self._remember(key, texts)
+        return texts
+
+    def put(self, key, texts):
+        """Store texts as the result of key.
+        """
+        texts = tuple(texts)
+        self._remember(key, texts)
+        if self.directory is None:
+            return
+
+        data = (STREAM_DELIMITER + '\n').join(texts)
+        path = os.path.join(self.directory, key)
+        temp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp, 'wt') as cached:
+            cached.write(data)
+        os.replace(temp, path)
+
+        if self._disk_bytes is None:
+            self.evict()
+        else:
+            self._disk_bytes += len(data)
+            if self._disk_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """Remove least recently used files until max_bytes is satisfied.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if '.' in entry.name or not entry.is_file():
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._disk_bytes = total
+
+    def convert(self, text):
+        """Return the converted texts of text, from the cache if possible.
+        """
+        key = self.key(text)
+        texts = self.get(key)
+        if texts is None:
+            self.misses += 1
+            texts = Pattern.from_text(text).convert()
+            self.put(key, texts)
+        else:
+            self.hits += 1
+        return list(texts)
+
+
+@functools.lru_cache(maxsize=None)
+def get_cache(directory, max_bytes):
+    """Return the cache of this process shared by conversions in directory.
+    """
+    return ConversionCache(directory=directory, max_bytes=max_bytes)
+
+
+def print_cache(cache):
+    """Print hit/miss counters of cache.
+    """
+    print('Cache: {} hits, {} misses'.format(cache.hits, cache.misses))
+
+
+def pack_pattern(pattern):
+    """Pack pattern into a record of PatternStore.
+
+    Each step takes 2 bytes: the note, and state, slide and accent in 2
+    bits each.
+    """
+    steps = Pattern.STEPS
+    if max(pattern.steps[steps:]) > 3:
+        raise ValueError('Pattern cannot be packed: {}'.format(pattern))
+    note, state, slide, accent = (
+        pattern.steps[index * steps:(index + 1) * steps]
+        for index in range(4))
+    try:
+        return PatternStore.RECORD.pack(
+            pattern.machine.value,
+            pattern.length,
+            pattern.triplet,
+            PatternStore.GATE_WIDTH,
+            bytes(note) + bytes(
+                st | sl << 2 | ac << 4
+                for st, sl, ac in zip(state, slide, accent)),
+        )
+    except (OverflowError, ValueError):
+        raise ValueError('Pattern cannot be packed: {}'.format(pattern))
+
+
+def unpack_pattern(record):
+    """Unpack a record of PatternStore into a Pattern.
+    """
+    machine, length, triplet, _, steps = PatternStore.RECORD.unpack(record)
+    note = steps[:Pattern.STEPS]
+    flags = steps[Pattern.STEPS:]
+    return Pattern(
+        Machine(machine), length, triplet,
+        note
+        + bytes(f & 3 for f in flags)
+        + bytes(f >> 2 & 3 for f in flags)
+        + bytes(f >> 4 & 3 for f in flags),
     )
-    args = parser.parse_args()
 
-    input_file = args.INPUT_FILE
-    output_file = args.OUTPUT_FILE
-    VERBOSE = args.verbose
 
-    main(input_file, output_file)
+class PatternStore(object):
+    """Binary file of fixed-size pattern records.
+
+    The file starts with a header of magic, version, record size and the
+    number of records, followed by records of pack_pattern(), so that any
+    pattern is read by its index with one seek.
+    """
+    MAGIC = b'TBPS'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHHI')
+    # machine, length, triplet, gate width and 32 steps of 2 bytes
+    RECORD = struct.Struct('<Bbbb64s')
+    # GATE_WIDTH written by tb3_text(), which is not read from files
+    GATE_WIDTH = 67
+
+    def __init__(self, path, mode='r'):
+        """Open a store at path for reading ('r'), appending ('a') or
+        writing a new one ('w').
+        """
+        if mode == 'w' or (mode == 'a' and not os.path.exists(path)):
+            self.file = open(path, 'w+b')
+            self.count = 0
+            self._write_header()
+        else:
+            self.file = open(path, 'rb' if mode == 'r' else 'r+b')
+            header = self.file.read(self.HEADER.size)
+            try:
+                magic, version, size, self.count = self.HEADER.unpack(header)
+            except struct.error:
+                magic = version = size = None
+            if magic != self.MAGIC:
+                self.file.close()
+                raise ValueError('Not a pattern store: {}'.format(path))
+            if version != self.VERSION or size != self.RECORD.size:
+                self.file.close()
+                raise ValueError(
+                    'Unsupported pattern store version: {}'.format(version))
+        self.mode = mode
+
+    def _write_header(self):
+        self.file.seek(0)
+        self.file.write(self.HEADER.pack(
+            self.MAGIC, self.VERSION, self.RECORD.size, self.count))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('pattern index out of range')
+        self.file.seek(self.HEADER.size + index * self.RECORD.size)
+        return unpack_pattern(self.file.read(self.RECORD.size))
+
+    def __iter__(self):
+        self.file.seek(self.HEADER.size)
+        for _ in range(self.count):
+            yield unpack_pattern(self.file.read(self.RECORD.size))
+
+    def append(self, pattern):
+        """Append pattern and return its index.
+        """
+        self.file.seek(self.HEADER.size + self.count * self.RECORD.size)
+        self.file.write(pack_pattern(pattern))
+        self.count += 1
+        return self.count - 1
+
+    def close(self):
+        """Write the header if modified, and close the file.
+        """
+        if self.file.closed:
+            return
+        if self.mode != 'r':
+            self._write_header()
+        self.file.close()
+
+
+def _index_file(path):
+    # runs in a worker process of PatternLibrary.update()
+    try:
+        stat = os.stat(path)
+        records = []
+        for chunk in iter_archive(path):
+            pattern = Pattern.from_buffer(chunk)
+            note, state, slide, accent = pattern.used_steps()
+            records.append((
+                pattern.machine.value, pattern.length, pattern.triplet,
+                pattern.fingerprint(),
+                list(zip(
+                    range(1, len(note) + 1), note, state, slide, accent)),
+            ))
+        if not records:
+            raise ValueError('Invalid file type.')
+    except (OSError, ValueError) as e:
+        return path, None, None, e
+    return path, stat.st_mtime_ns, stat.st_size, records
+
+
+class PatternLibrary(object):
+    """SQLite index of patterns in PRM files, searchable by content.
+
+    Steps up to the last step of each pattern are indexed with their
+    note, state (as written in TB-03 files), slide and accent, together
+    with the fingerprint of the pattern.
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            mtime INTEGER NOT NULL,
+            size INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS patterns (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL REFERENCES files(path) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            machine INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            triplet INTEGER NOT NULL,
+            fingerprint TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS steps (
+            pattern INTEGER NOT NULL
+                REFERENCES patterns(id) ON DELETE CASCADE,
+            step INTEGER NOT NULL,
+            note INTEGER NOT NULL,
+            state INTEGER NOT NULL,
+            slide INTEGER NOT NULL,
+            accent INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS patterns_path ON patterns(path);
+        CREATE INDEX IF NOT EXISTS patterns_fingerprint
+            ON patterns(fingerprint);
+        CREATE INDEX IF NOT EXISTS steps_pattern ON steps(pattern);
+        CREATE INDEX IF NOT EXISTS steps_note ON steps(note, step);
+    '''
+
+    def __init__(self, path):
+        import sqlite3
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(self.SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def update(self, sources, jobs=None):
+        """Index PRM files found in sources, skipping unchanged files.
+
+        Files are parsed with a process pool unless jobs is 1, and files
+        no longer existing are dropped from the index. Return (indexed,
+        unchanged, removed, failed), where failed is a list of
+        (path, error).
+        """
+        known = dict(
+            (path, (mtime, size)) for path, mtime, size
+            in self.db.execute('SELECT path, mtime, size FROM files'))
+
+        paths = []
+        unchanged = 0
+        for source in sources:
+            for path in find_inputs(source) or [source]:
+                path = os.path.abspath(path)
+                if not os.path.isfile(path):
+                    continue
+                stat = os.stat(path)
+                if known.get(path) == (stat.st_mtime_ns, stat.st_size):
+                    unchanged += 1
+                else:
+                    paths.append(path)
+
+        removed = [path for path in known if not os.path.exists(path)]
+        with self.db:
+            self.db.executemany(
+                'DELETE FROM files WHERE path = ?',
+                [(path,) for path in removed])
+
+        if jobs == 1:
+            failed = self._store(map(_index_file, paths))
+        else:
+            import concurrent.futures
+
+            with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+                failed = self._store(
+                    pool.map(_index_file, paths, chunksize=16))
+
+        return len(paths) - len(failed), unchanged, len(removed), failed
+
+    def _store(self, results):
+        failed = []
+        with self.db:
+            for path, mtime, size, records in results:
+                self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+                if mtime is None:
+                    failed.append((path, records))
+                    continue
+                self.db.execute(
+                    'INSERT INTO files VALUES (?, ?, ?)', (path, mtime, size))
+                for position, record in enumerate(records):
+                    pattern = self.db.execute(
+                        'INSERT INTO patterns (path, position, machine, '
+                        'length, triplet, fingerprint) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (path, position) + record[:4],
+                    ).lastrowid
+                    self.db.executemany(
+                        'INSERT INTO steps VALUES (?, ?, ?, ?, ?, ?)',
+                        [(pattern,) + step for step in record[4]])
+        return failed
+
+    def search(self, step=None, note=None, state=None, slide=None,
+               accent=None):
+        """Return (path, position) of patterns having a step that matches
+        all given values.
+        """
+        conditions = []
+        values = []
+        for column, value in (('step', step), ('note', note),
+                              ('state', state), ('slide', slide),
+                              ('accent', accent)):
+            if value is not None:
+                conditions.append('steps.{} = ?'.format(column))
+                values.append(value)
+
+        query = (
+            'SELECT DISTINCT patterns.path, patterns.position FROM patterns '
+            'JOIN steps ON steps.pattern = patterns.id'
+        )
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY patterns.path, patterns.position'
+        return list(self.db.execute(query, values))
+
+    def duplicates(self):
+        """Return lists of (path, position) of patterns sharing their
+        fingerprint.
+        """
+        groups = collections.OrderedDict()
+        for fingerprint, path, position in self.db.execute(
+                'SELECT fingerprint, path, position FROM patterns '
+                'WHERE fingerprint IN ('
+                '    SELECT fingerprint FROM patterns '
+                '    GROUP BY fingerprint HAVING COUNT(*) > 1) '
+                'ORDER BY fingerprint, path, position'):
+            groups.setdefault(fingerprint, []).append((path, position))
+        return list(groups.values())
+
+    def similar(self, path, position=0, max_diff=1):
+        """Return (path, position, diff) of patterns of the same length and
+        triplet as the pattern at position in path, differing from it in
+        at most max_diff steps.
+        """
+        return list(self.db.execute(
+            'SELECT other.path, other.position, SUM('
+            '    a.note != b.note OR a.state != b.state'
+            '    OR a.slide != b.slide OR a.accent != b.accent) AS diff '
+            'FROM patterns AS this '
+            'JOIN steps AS a ON a.pattern = this.id '
+            'JOIN patterns AS other ON other.length = this.length '
+            '    AND other.triplet = this.triplet AND other.id != this.id '
+            'JOIN steps AS b ON b.pattern = other.id AND b.step = a.step '
+            'WHERE this.path = ? AND this.position = ? '
+            'GROUP BY other.id HAVING diff <= ? '
+            'ORDER BY diff, other.path, other.position',
+            (os.path.abspath(path), position, max_diff)))
+
+
+def convert_text(text, output_file='output.prm', cache=None):
+    """Convert the text of a PRM file without touching the filesystem.
+
+    Return a list of (suggested_name, text) for output_file.
+    """
+    if cache is None:
+        out_texts = Pattern.from_text(text).convert()
+    else:
+        out_texts = cache.convert(text)
+    return list(zip(output_names(output_file, len(out_texts)), out_texts))
+
+
+def convert_bytes(data, output_file='output.prm', encoding='ascii'):
+    """Convert bytes or a binary file object of a PRM file in memory.
+
+    Return a list of (suggested_name, bytes) for output_file.
+    """
+    if hasattr(data, 'read'):
+        data = data.read()
+    return [
+        (name, out_text.encode(encoding))
+        for name, out_text in convert_text(data.decode(encoding), output_file)
+    ]
+
+
+def _file_outputs(text, output_file, cache):
+    # lines are streamed into files unless texts are needed for the cache
+    if cache is not None:
+        return convert_text(text, output_file, cache)
+    out_lines = Pattern.from_text(text).convert_lines()
+    return zip(output_names(output_file, len(out_lines)), out_lines)
+
+
+def convert_file(input_file, output_file, cache=None):
+    """Convert input_file and write the result to output_file.
+
+    Return the list of written files.
+    """
+    return write_outputs(
+        _file_outputs(read_text(input_file), output_file, cache))
+
+
+# line separating patterns in a stream
+STREAM_DELIMITER = '%%'
+
+
+def read_stream(infile):
+    """Yield lines of each pattern in a stream separated by STREAM_DELIMITER.
+    """
+    record = []
+    for line in infile:
+        if line.rstrip('\r\n') == STREAM_DELIMITER:
+            if record:
+                yield record
+            record = []
+        elif record or line.strip():
+            record.append(line)
+    if record:
+        yield record
+
+
+def iter_archive(path):
+    """Yield a memoryview of each pattern in an archive of PRM files.
+
+    The archive is memory-mapped and split at the first line of each
+    pattern, so each view is only valid until the next one is requested.
+    Raise ValueError if no pattern is found, if anything but blank lines
+    comes before the first one, or if a pattern has a second LAST_STEP or
+    TB-03 TRIPLET line, as when the first line of the next one is damaged.
+    """
+    import mmap
+    import re
+
+    with open(path, 'rb') as archive:
+        if os.fstat(archive.fileno()).st_size == 0:
+            raise ValueError('Invalid file type.')
+        with mmap.mmap(
+                archive.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                start = None
+                header = False
+                # first line of each pattern, or its second header line
+                for match in re.finditer(
+                        rb'^(?:(TRIPLET\(|END_STEP)|LAST_STEP|TRIPLET\s*=)',
+                        mapped, re.MULTILINE):
+                    if match.group(1) is None:
+                        if start is None or header:
+                            raise ValueError(
+                                'Invalid pattern at byte {}.'.format(
+                                    match.start()))
+                        header = True
+                        continue
+
+                    if start is not None:
+                        with view[start:match.start()] as chunk:
+                            yield chunk
+                    elif mapped[:match.start()].strip():
+                        raise ValueError(
+                            'Invalid data before the first pattern.')
+                    start = match.start()
+                    header = False
+                if start is None:
+                    raise ValueError('Invalid file type.')
+                with view[start:] as chunk:
+                    yield chunk
+
+
+def convert_patterns(patterns, outfile, bank_size=1):
+    """Convert patterns and write them to outfile as a stream.
+
+    A TB-3 pattern longer than 16 steps is written as two consecutive
+    records. When bank_size is more than 1, patterns are converted in
+    banks of that size with convert_bank(), and a bank_size less than 1
+    is taken as 1. Return the number of written records.
+    """
+    patterns = iter(patterns)
+    bank_size = max(bank_size, 1)
+    count = 0
+    while True:
+        bank = list(itertools.islice(patterns, bank_size))
+        if not bank:
+            break
+
+        if bank_size > 1:
+            results = convert_bank(bank)
+        else:
+            results = [pattern.convert() for pattern in bank]
+
+        for out_texts in results:
+            for out_text in out_texts:
+                if count:
+                    outfile.write(STREAM_DELIMITER + '\n')
+                outfile.write(out_text)
+                count += 1
+    return count
+
+
+def convert_stream(infile, outfile, bank_size=1):
+    """Convert patterns separated by STREAM_DELIMITER in infile.
+
+    See convert_patterns() for the output.
+    """
+    return convert_patterns(
+        (Pattern.from_lines(record) for record in read_stream(infile)),
+        outfile, bank_size)
+
+
+def convert_archive(path, outfile, bank_size=1):
+    """Convert patterns in an archive of concatenated PRM files at path.
+
+    See convert_patterns() for the output.
+    """
+    return convert_patterns(
+        (Pattern.from_buffer(chunk) for chunk in iter_archive(path)),
+        outfile, bank_size)
+
+
+def stream_main(input_file, output_file, bank_size=1):
+    """Entry point of stream mode, where '-' means stdin/stdout.
+
+    Input files other than stdin are read as archives with mmap.
+    """
+    outfile = sys.stdout if output_file == '-' else open(output_file, 'wt')
+    try:
+        if input_file == '-':
+            convert_stream(sys.stdin, outfile, bank_size)
+        else:
+            convert_archive(input_file, outfile, bank_size)
+    except (OSError, ValueError) as e:
+        print('tbconv: {}'.format(e), file=sys.stderr)
+        return 1
+    finally:
+        if outfile is not sys.stdout:
+            outfile.close()
+
+    return 0
+
+
+# suffix of bundles and the mode of tarfile to write them
+BUNDLE_FORMATS = collections.OrderedDict([
+    ('.zip', None),
+    ('.tar', 'w'),
+    ('.tar.gz', 'w:gz'),
+    ('.tgz', 'w:gz'),
+    ('.tar.bz2', 'w:bz2'),
+    ('.tar.xz', 'w:xz'),
+])
+
+
+def bundle_format(path):
+    """Return the suffix in BUNDLE_FORMATS of a bundle path, or None.
+    """
+    lower = path.lower()
+    for suffix in reversed(BUNDLE_FORMATS):
+        if lower.endswith(suffix):
+            return suffix
+    return None
+
+
+def iter_bundle(path):
+    """Yield (name, mtime, data) of each regular file in a zip or tar
+    bundle, without extracting it.
+    """
+    if bundle_format(path) == '.zip':
+        import time
+        import zipfile
+
+        with zipfile.ZipFile(path) as bundle:
+            for info in bundle.infolist():
+                if not info.is_dir():
+                    mtime = time.mktime(info.date_time + (0, 0, -1))
+                    yield info.filename, mtime, bundle.read(info)
+    else:
+        import tarfile
+
+        # read sequentially, as the bundle may be compressed
+        with tarfile.open(path, 'r|*') as bundle:
+            for member in bundle:
+                if member.isfile():
+                    yield (member.name, member.mtime,
+                           bundle.extractfile(member).read())
+
+
+class BundleWriter(object):
+    """Writer of a new zip or tar bundle, chosen by the suffix of path.
+
+    The bundle is written to a temporary file renamed to path by close(),
+    and removed instead if the writer exits with an exception.
+    """
+    def __init__(self, path):
+        suffix = bundle_format(path)
+        if suffix is None:
+            raise ValueError('Not a zip or tar bundle: {}'.format(path))
+
+        self.path = path
+        self.temp = '{}.{}.tmp'.format(path, os.getpid())
+        if suffix == '.zip':
+            import zipfile
+
+            self.bundle = zipfile.ZipFile(
+                self.temp, 'w', compression=zipfile.ZIP_DEFLATED)
+        else:
+            import tarfile
+
+            self.bundle = tarfile.open(self.temp, BUNDLE_FORMATS[suffix])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add(self, name, data, mtime):
+        """Add bytes data as a file of name.
+        """
+        if hasattr(self.bundle, 'writestr'):
+            import time
+            import zipfile
+
+            # zip stores years from 1980 to 2107 only
+            date_time = min(
+                max(time.localtime(mtime)[:6], (1980, 1, 1, 0, 0, 0)),
+                (2107, 12, 31, 23, 59, 58))
+            info = zipfile.ZipInfo(name, date_time)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            self.bundle.writestr(info, data)
+        else:
+            import io
+            import tarfile
+
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = mtime
+            self.bundle.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self.bundle.close()
+        os.replace(self.temp, self.path)
+
+    def abort(self):
+        """Discard the bundle, leaving path as it was.
+        """
+        try:
+            self.bundle.close()
+        finally:
+            _remove(self.temp)
+
+
+def convert_bundle(input_file, output_file, cache=None):
+    """Convert PRM files in a zip or tar bundle into a new bundle.
+
+    Members are converted in memory, split TB-3 patterns are written as
+    two members, and other files are copied as they are. Return a list of
+    (member, output_members, error) of PRM files.
+
+    output_file is only replaced once the whole bundle is converted, and
+    must not be input_file.
+    """
+    if (os.path.exists(output_file)
+            and os.path.samefile(input_file, output_file)):
+        raise ValueError('Input and output are the same file: {}'.format(
+            output_file))
+
+    results = []
+    with BundleWriter(output_file) as bundle:
+        for name, mtime, data in iter_bundle(input_file):
+            if not name.lower().endswith('.prm'):
+                bundle.add(name, data, mtime)
+                continue
+
+            try:
+                outputs = convert_text(data.decode('ascii'), name, cache)
+            except (UnicodeDecodeError, ValueError) as e:
+                results.append((name, [], e))
+                continue
+            for out_name, out_text in outputs:
+                bundle.add(out_name, out_text.encode('ascii'), mtime)
+            results.append((name, [out_name for out_name, _ in outputs], None))
+
+    return results
+
+
+def bundle_main(input_file, output_file, cache=None):
+    """Entry point of bundle mode, where input_file is a zip or tar bundle.
+    """
+    if bundle_format(output_file) is None:
+        print('Output of a bundle must be a zip or tar file: {}'.format(
+            output_file))
+        return 1
+
+    import tarfile
+    import zipfile
+    import zlib
+
+    print('Converting bundle {} to {}\n'.format(input_file, output_file))
+    try:
+        results = convert_bundle(input_file, output_file, cache)
+    except (OSError, ValueError, EOFError, zipfile.BadZipFile,
+            tarfile.TarError, zlib.error) as e:
+        print('Invalid bundle: {}'.format(e))
+        return 1
+
+    failed = 0
+    for member, outputs, error in results:
+        if error is None:
+            print('OK      {} -> {}'.format(member, ', '.join(outputs)))
+        else:
+            failed += 1
+            print('FAILED  {}: {}'.format(member, error))
+    print('{} converted, {} failed.'.format(len(results) - failed, failed))
+
+    return 1 if failed else 0
+
+
+# Stats being collected, set by Stats.install()
+STATS = None
+
+
+class Stats(object):
+    """Timers and counters of the conversion stages.
+
+    install() replaces the instrumented functions of this module with
+    timing wrappers, so that nothing is added to the hot path otherwise.
+    """
+    # instrumented function and the counter of its calls
+    INSTRUMENTED = {
+        'get_machine_type': None,
+        'read_param': None,
+        'read_params': None,
+        'read_text': 'files_read',
+        'write_file': None,
+        'write_outputs': None,
+        'write_params': None,
+    }
+
+    def __init__(self):
+        self.seconds = collections.Counter()
+        self.calls = collections.Counter()
+        self.counters = collections.Counter()
+        self.originals = {}
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    def install(self):
+        """Start collecting stats.
+        """
+        global STATS
+
+        module = sys.modules[__name__]
+        for name, counter in self.INSTRUMENTED.items():
+            func = getattr(module, name)
+            self.originals[name] = func
+            setattr(module, name, self._timed(name, func, counter))
+        STATS = self
+
+    def uninstall(self):
+        """Stop collecting stats.
+        """
+        global STATS
+
+        module = sys.modules[__name__]
+        for name, func in self.originals.items():
+            setattr(module, name, func)
+        self.originals = {}
+        STATS = None
+
+    def _timed(self, name, func, counter):
+        import time
+
+        seconds = self.seconds
+        calls = self.calls
+        counters = self.counters
+        perf_counter = time.perf_counter
+        if name == 'write_outputs':
+            func = self._counted_outputs(func)
+        elif name == 'write_file':
+            func = self._counted_writes(func)
+        elif name == 'read_params':
+            func = self._counted_lines(func)
+        elif name == 'read_text':
+            func = self._counted_input(func)
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds[name] += perf_counter() - start
+                calls[name] += 1
+                if counter is not None:
+                    counters[counter] += 1
+        return timed
+
+    def _counted_input(self, func):
+        counters = self.counters
+
+        @functools.wraps(func)
+        def read_text(input_file):
+            text = func(input_file)
+            counters['bytes_read'] += os.path.getsize(input_file)
+            return text
+        return read_text
+
+    def _counted_lines(self, func):
+        counters = self.counters
+
+        @functools.wraps(func)
+        def read_params(lines, *args):
+            lines = list(lines)
+            counters['lines_parsed'] += len(lines)
+            return func(lines, *args)
+        return read_params
+
+    def _counted_outputs(self, func):
+        counters = self.counters
+
+        def count_steps(lines):
+            for line in lines:
+                if line.startswith('STEP'):
+                    counters['steps_written'] += 1
+                yield line
+
+        @functools.wraps(func)
+        def write_outputs(outputs):
+            written = func(
+                (output_file, count_steps(
+                    out_text.splitlines(True)
+                    if isinstance(out_text, str) else out_text))
+                for output_file, out_text in outputs)
+            counters['files_written'] += len(written)
+            counters['files_split'] += len(written) > 1
+            return written
+        return write_outputs
+
+    def _counted_writes(self, func):
+        counters = self.counters
+
+        @functools.wraps(func)
+        def write_file(output_file, text):
+            if func(output_file, text):
+                counters['bytes_written'] += len(text)
+                return True
+            counters['files_unchanged'] += 1
+            return False
+        return write_file
+
+    def as_dict(self):
+        """Return stats as a dict of plain values for JSON.
+        """
+        return {
+            'timers': dict(
+                (name, {'calls': self.calls[name], 'seconds': seconds})
+                for name, seconds in self.seconds.items()),
+            'counters': dict(self.counters),
+        }
+
+    def merge(self, stats):
+        """Add stats of as_dict(), e.g. from a worker process.
+        """
+        for name, timer in stats['timers'].items():
+            self.calls[name] += timer['calls']
+            self.seconds[name] += timer['seconds']
+        self.counters.update(stats['counters'])
+
+    def summary(self):
+        """Return lines of a human-readable summary.
+        """
+        lines = ['Stats:']
+        for name in sorted(self.seconds):
+            lines.append('  {:<18} {:>10,} calls {:>10.6f} s'.format(
+                name, self.calls[name], self.seconds[name]))
+        for name in sorted(self.counters):
+            lines.append('  {:<18} {:>10,}'.format(name, self.counters[name]))
+        return lines
+
+
+def add_stats_arguments(parser):
+    """Add arguments of instrumentation to parser.
+    """
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help='Print timers and counters of conversion stages.',
+    )
+    parser.add_argument(
+        '--stats-json',
+        metavar='FILE',
+        default=None,
+        help='Write timers and counters of conversion stages as JSON.',
+    )
+    parser.add_argument(
+        '--profile',
+        metavar='FILE',
+        default=None,
+        help='Write a cProfile dump of the conversion.',
+    )
+
+
+def instrumented(args, func, *func_args, **func_kwargs):
+    """Call func with the instrumentation requested by arguments of
+    add_stats_arguments(), and return its result.
+    """
+    stats = None
+    if args.stats or args.stats_json is not None:
+        stats = Stats()
+        stats.install()
+    profiler = None
+    if args.profile is not None:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        return func(*func_args, **func_kwargs)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if stats is not None:
+            stats.uninstall()
+            if args.stats:
+                print('\n'.join(stats.summary()))
+            if args.stats_json is not None:
+                import json
+
+                with open(args.stats_json, 'wt') as f:
+                    json.dump(stats.as_dict(), f, indent=2, sort_keys=True)
+
+
+def main(input_file, output_file, cache=None):
+    if not(os.path.exists(input_file)):
+        print('No such file: {}'.format(input_file))
+        return
+
+    if bundle_format(input_file) is not None:
+        return bundle_main(input_file, output_file, cache)
+
+    text = read_text(input_file)
+
+    machine = get_machine_type(text)
+    if machine == Machine.UNKNOWN:
+        print('Invalid file type.')
+        exit()
+
+    convert_to = Machine.TB03 if machine == Machine.TB3 else Machine.TB3
+    print('Converting backup file from {} to {}\n'.format(
+        machine.name, convert_to.name))
+
+    if VERBOSE:
+        vprint([
+            '----------',
+            'Input File: {}'.format(input_file),
+            '----------',
+            '',
+        ])
+        vprint(text, end='')
+
+    written = write_outputs(_file_outputs(text, output_file, cache))
+    if FSYNC:
+        sync_directories(written)
+    print_split(output_file, written)
+
+    print('Conversion complete.')
+
+
+def find_inputs(source):
+    """Find PRM files from a directory or a glob pattern.
+    """
+    import glob
+
+    if os.path.isdir(source):
+        return sorted(
+            os.path.join(source, name) for name in os.listdir(source)
+            if name.lower().endswith('.prm')
+            and os.path.isfile(os.path.join(source, name))
+        )
+    return sorted(glob.glob(source))
+
+
+def output_files(input_files, output_dir):
+    """Return the output file in output_dir of each of input_files.
+
+    Paths of input_files relative to their deepest common directory are
+    kept under output_dir, whose subdirectories are made, so that inputs
+    of the same name in different directories do not overwrite each
+    other's outputs.
+    """
+    if not input_files:
+        return []
+    paths = [os.path.abspath(input_file) for input_file in input_files]
+    root = os.path.commonpath([os.path.dirname(path) for path in paths])
+    outputs = [
+        os.path.join(output_dir, os.path.relpath(path, root))
+        for path in paths]
+    for directory in set(os.path.dirname(output) for output in outputs):
+        os.makedirs(directory, exist_ok=True)
+    return outputs
+
+
+class Journal(object):
+    """Append-only journal of inputs completed by batch().
+
+    Each line is a JSON list of an input file with its mtime and size,
+    followed by (output_file, size, sha256) of its outputs. Lines are
+    fsynced by flush(), and a line cut by a crash is removed when read.
+    """
+    def __init__(self, path):
+        import json
+
+        self.entries = {}
+        # end of the last complete line
+        end = 0
+        try:
+            with open(path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    end += len(line)
+                    try:
+                        input_file, mtime, size, *outputs = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[input_file] = (mtime, size, outputs)
+        except FileNotFoundError:
+            pass
+        self.file = open(path, 'at')
+        # a line cut by a crash is cut off, so that the next line written
+        # does not continue it
+        if self.file.tell() > end:
+            self.file.truncate(end)
+        self.lines = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _digest(path):
+        import hashlib
+
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def done(self, input_file, verify=False):
+        """Return True if input_file is unchanged since it was recorded,
+        and its outputs have the recorded size (and hash with verify).
+        """
+        entry = self.entries.get(os.path.abspath(input_file))
+        if entry is None:
+            return False
+        mtime, size, outputs = entry
+        try:
+            stat = os.stat(input_file)
+            if (stat.st_mtime_ns, stat.st_size) != (mtime, size):
+                return False
+            for output_file, output_size, digest in outputs:
+                if os.path.getsize(output_file) != output_size:
+                    return False
+                if verify and self._digest(output_file) != digest:
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def record(self, input_file, output_files):
+        """Record input_file as completed with output_files, which is
+        written by the next flush().
+        """
+        import json
+
+        input_file = os.path.abspath(input_file)
+        stat = os.stat(input_file)
+        entry = [input_file, stat.st_mtime_ns, stat.st_size] + [
+            [os.path.abspath(output_file), os.path.getsize(output_file),
+             self._digest(output_file)]
+            for output_file in output_files]
+        self.entries[input_file] = (entry[1], entry[2], entry[3:])
+        self.lines.append(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    def flush(self):
+        """Write recorded lines and fsync the journal.
+        """
+        if not self.lines:
+            return
+        self.file.writelines(self.lines)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.lines = []
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        self.file.close()
+
+
+def _batch_convert(input_file, output_file, cache_dir, cache_bytes,
+                   collect=False, fsync=False):
+    # runs in a worker process, where the cache lives across tasks
+    global FSYNC
+
+    FSYNC = fsync
+    if collect:
+        with Stats() as stats:
+            written, cached, _ = _batch_convert(
+                input_file, output_file, cache_dir, cache_bytes,
+                fsync=fsync)
+        return written, cached, stats.as_dict()
+
+    if cache_dir is None:
+        return convert_file(input_file, output_file), False, None
+
+    cache = get_cache(cache_dir, cache_bytes)
+    hits = cache.hits
+    written = convert_file(input_file, output_file, cache)
+    return written, cache.hits > hits, None
+
+
+def batch(input_files, output_dir, jobs=None,
+          cache_dir=None, cache_bytes=64 * 1024 * 1024,
+          journal=None, verify=False, batch_size=1000, fsync=False):
+    """Convert input_files into output_dir with a process pool.
+
+    Return a list of (input_file, output_files, error, cached) in input
+    order, where outputs are named as by output_files(). Stats of
+    workers are added to STATS if it is collected.
+
+    With a Journal, inputs it records as done (see Journal.done()) are
+    skipped and left out of the result, and converted inputs are recorded
+    and fsynced after each batch_size inputs.
+
+    With fsync, every output file is fsynced before it is renamed into
+    place, and the output directories once after each batch_size inputs.
+    """
+    import concurrent.futures
+
+    os.makedirs(output_dir, exist_ok=True)
+    # of all inputs, so that skipped ones do not move the others
+    output_names = dict(
+        zip(input_files, output_files(input_files, output_dir)))
+    if journal is not None:
+        input_files = [
+            input_file for input_file in input_files
+            if not journal.done(input_file, verify)]
+
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        for start in range(0, len(input_files), batch_size):
+            chunk = input_files[start:start + batch_size]
+            futures = [
+                pool.submit(
+                    _batch_convert,
+                    input_file,
+                    output_names[input_file],
+                    cache_dir,
+                    cache_bytes,
+                    STATS is not None,
+                    fsync,
+                )
+                for input_file in chunk
+            ]
+            outputs = []
+            for input_file, future in zip(chunk, futures):
+                try:
+                    written, cached, stats = future.result()
+                    if stats is not None:
+                        STATS.merge(stats)
+                    results.append((input_file, written, None, cached))
+                except Exception as e:
+                    results.append((input_file, [], e, False))
+                    continue
+                outputs.extend(written)
+                if journal is not None:
+                    journal.record(input_file, written)
+            if fsync:
+                sync_directories(outputs)
+            if journal is not None:
+                journal.flush()
+
+    return results
+
+
+def add_cache_arguments(parser):
+    """Add arguments of the conversion cache to parser.
+    """
+    parser.add_argument(
+        '--cache-dir',
+        default=None,
+        help='Directory to cache converted results.',
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=64,
+        help='Size limit of the cache directory in MiB. (default: 64)',
+    )
+
+
+def batch_main(argv):
+    """Entry point of batch mode.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='tbconv.py batch')
+    parser.add_argument(
+        'INPUT',
+        help='Directory or glob pattern of files to convert.',
+    )
+    parser.add_argument(
+        'OUTPUT_DIR',
+        help='Directory to write converted files.',
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=None,
+        help='Number of worker processes. (default: number of CPUs)',
+    )
+    parser.add_argument(
+        '--journal',
+        metavar='FILE',
+        default=None,
+        help='Journal of completed inputs, which are skipped when the '
+             'batch is run again.',
+    )
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        help='Verify outputs of journaled inputs by hash as well as size.',
+    )
+    parser.add_argument(
+        '--fsync',
+        action='store_true',
+        help='fsync output files and their directories.',
+    )
+    add_cache_arguments(parser)
+    add_stats_arguments(parser)
+    args = parser.parse_args(argv)
+
+    input_files = find_inputs(args.INPUT)
+    if not input_files:
+        print('No input files: {}'.format(args.INPUT))
+        return 1
+
+    journal = None if args.journal is None else Journal(args.journal)
+    try:
+        results = instrumented(
+            args, batch, input_files, args.OUTPUT_DIR, args.jobs,
+            args.cache_dir, args.cache_size * 1024 * 1024,
+            journal, args.verify, fsync=args.fsync)
+    finally:
+        if journal is not None:
+            journal.close()
+
+    failed = 0
+    hits = 0
+    for input_file, outputs, error, cached in results:
+        if error is None:
+            hits += cached
+            print('OK      {} -> {}'.format(input_file, ', '.join(outputs)))
+        else:
+            failed += 1
+            print('FAILED  {}: {}'.format(input_file, error))
+    print('{} converted, {} failed.'.format(len(results) - failed, failed))
+    if journal is not None:
+        print('{} skipped as done in {}.'.format(
+            len(input_files) - len(results), args.journal))
+    if args.cache_dir is not None:
+        print('Cache: {} hits, {} misses'.format(
+            hits, len(results) - failed - hits))
+
+    return 1 if failed else 0
+
+
+# manifest of sync mode in the destination directory
+SYNC_MANIFEST = '.tbconv-sync.json'
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def sync(source, destination):
+    """Convert PRM files under source into destination incrementally.
+
+    Only files whose mtime/size and content hash changed since the last
+    sync, or whose outputs are missing, are converted. Outputs of removed
+    inputs are deleted. Return (converted, unchanged, removed, failed),
+    where failed is a list of (input_file, error).
+    """
+    import hashlib
+    import json
+
+    manifest_file = os.path.join(destination, SYNC_MANIFEST)
+    try:
+        with open(manifest_file, 'rt') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    def outputs_exist(entry):
+        return all(
+            os.path.exists(os.path.join(destination, output))
+            for output in entry['outputs'])
+
+    new_manifest = {}
+    seen = set()
+    converted = []
+    unchanged = 0
+    failed = []
+    for dirpath, dirnames, filenames in os.walk(source):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if not name.lower().endswith('.prm'):
+                continue
+            input_file = os.path.join(dirpath, name)
+            rel = os.path.relpath(input_file, source)
+            seen.add(rel)
+            stat = os.stat(input_file)
+            entry = manifest.get(rel)
+
+            if (entry is not None
+                    and entry['mtime'] == stat.st_mtime_ns
+                    and entry['size'] == stat.st_size
+                    and outputs_exist(entry)):
+                new_manifest[rel] = entry
+                unchanged += 1
+                continue
+
+            with open(input_file, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()
+            if (entry is not None
+                    and entry['hash'] == digest
+                    and outputs_exist(entry)):
+                new_manifest[rel] = dict(
+                    entry, mtime=stat.st_mtime_ns, size=stat.st_size)
+                unchanged += 1
+                continue
+
+            output_file = os.path.join(destination, rel)
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            try:
+                written = write_outputs(
+                    convert_text(data.decode('ascii'), output_file))
+            except (UnicodeDecodeError, ValueError) as e:
+                failed.append((input_file, e))
+                continue
+
+            outputs = [
+                os.path.relpath(output, destination) for output in written]
+            if entry is not None:
+                for output in entry['outputs']:
+                    if output not in outputs:
+                        _remove(os.path.join(destination, output))
+            new_manifest[rel] = {
+                'mtime': stat.st_mtime_ns,
+                'size': stat.st_size,
+                'hash': digest,
+                'outputs': outputs,
+            }
+            converted.append(input_file)
+
+    removed = 0
+    for rel, entry in manifest.items():
+        if rel in new_manifest:
+            continue
+        for output in entry['outputs']:
+            _remove(os.path.join(destination, output))
+        if rel not in seen:
+            removed += 1
+
+    os.makedirs(destination, exist_ok=True)
+    temp = '{}.{}.tmp'.format(manifest_file, os.getpid())
+    with open(temp, 'wt') as f:
+        json.dump(new_manifest, f, sort_keys=True)
+    os.replace(temp, manifest_file)
+
+    return converted, unchanged, removed, failed
+
+
+def sync_main(argv):
+    """Entry point of sync mode.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='tbconv.py sync')
+    parser.add_argument(
+        'SRC',
+        help='Directory of files to convert.',
+    )
+    parser.add_argument(
+        'DST',
+        help='Directory to mirror converted files.',
+    )
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.SRC):
+        print('No such directory: {}'.format(args.SRC))
+        return 1
+
+    converted, unchanged, removed, failed = sync(args.SRC, args.DST)
+
+    for input_file in converted:
+        print('CONVERTED  {}'.format(input_file))
+    for input_file, error in failed:
+        print('FAILED     {}: {}'.format(input_file, error))
+    print('{} converted, {} unchanged, {} removed, {} failed.'.format(
+        len(converted), unchanged, removed, len(failed)))
+
+    return 1 if failed else 0
+
+
+def _is_watched(name):
+    return name.lower().endswith('.prm') and not name.startswith('.')
+
+
+class _PollingWatcher(object):
+    """Watcher of PRM files in a directory by polling their mtime/size.
+    """
+    def __init__(self, source, interval=1.0):
+        self.source = source
+        self.interval = interval
+        self.files = self._scan()
+
+    def _scan(self):
+        files = {}
+        with os.scandir(self.source) as entries:
+            for entry in entries:
+                if _is_watched(entry.name) and entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def changes(self, timeout):
+        """Wait up to timeout seconds and return names of changed files.
+        """
+        import time
+
+        time.sleep(min(timeout, self.interval))
+        files = self._scan()
+        changed = [
+            name for name, signature in files.items()
+            if self.files.get(name) != signature]
+        self.files = files
+        return changed
+
+    def close(self):
+        pass
+
+
+class _InotifyWatcher(object):
+    """Watcher of PRM files in a directory with inotify of Linux.
+    """
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, source):
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO
+        if libc.inotify_add_watch(self.fd, os.fsencode(source), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def changes(self, timeout):
+        """Wait up to timeout seconds and return names of changed files.
+        """
+        import select
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        names = []
+        offset = 0
+        while offset < len(data):
+            _, _, _, size = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + size].rstrip(b'\0'))
+            offset += size
+            if _is_watched(name):
+                names.append(name)
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+def open_watcher(source, polling=False):
+    """Return a watcher of PRM files in source, which uses inotify if
+    available and polls otherwise.
+    """
+    if not polling and sys.platform.startswith('linux'):
+        try:
+            return _InotifyWatcher(source)
+        except (AttributeError, OSError):
+            pass
+    return _PollingWatcher(source)
+
+
+def _convert_files(pairs):
+    # runs in a worker process with a burst of (input_file, output_file),
+    # where any failure of a file is its result
+    results = []
+    for input_file, output_file in pairs:
+        try:
+            results.append((input_file, convert_file(input_file, output_file),
+                            None))
+        except Exception as e:
+            results.append((input_file, [], e))
+    return results
+
+
+def _is_converted(input_file, output_file):
+    # any output is as new as input_file
+    mtime = os.stat(input_file).st_mtime_ns
+    return any(
+        os.path.exists(output) and os.stat(output).st_mtime_ns >= mtime
+        for output in [output_file] + output_names(output_file, 2))
+
+
+def watch(source, destination, jobs=None, debounce=0.2, polling=False,
+          stop=None):
+    """Convert PRM files arriving in source into destination.
+
+    A file is converted once no change is seen on it for debounce seconds,
+    and files becoming ready together are submitted to the process pool at
+    once. Each version of a file is converted once, and files already
+    converted before are skipped at start. Yield (input_file,
+    output_files, error) of converted files until stop.is_set() is true.
+    Failures are yielded as errors, and a pool broken by a dead worker
+    process is replaced, so that watching goes on.
+    """
+    import concurrent.futures
+    import time
+
+    os.makedirs(destination, exist_ok=True)
+    watcher = open_watcher(source, polling)
+    # name: time of the last change, or 0 to convert without waiting
+    pending = dict(
+        (name, 0) for name in sorted(os.listdir(source))
+        if _is_watched(name) and not _is_converted(
+            os.path.join(source, name), os.path.join(destination, name)))
+    # name: (mtime, size) of converted files
+    converted = {}
+    pool = concurrent.futures.ProcessPoolExecutor(jobs)
+    try:
+        workers = jobs or os.cpu_count() or 1
+        while stop is None or not stop.is_set():
+            for name in watcher.changes(debounce if pending else 1.0):
+                pending[name] = time.monotonic()
+
+            now = time.monotonic()
+            burst = []
+            for name, changed in list(pending.items()):
+                if now - changed < debounce:
+                    continue
+                del pending[name]
+                input_file = os.path.join(source, name)
+                try:
+                    stat = os.stat(input_file)
+                except FileNotFoundError:
+                    continue
+                signature = (stat.st_mtime_ns, stat.st_size)
+                if converted.get(name) == signature:
+                    continue
+                converted[name] = signature
+                burst.append(
+                    (input_file, os.path.join(destination, name)))
+            if not burst:
+                continue
+
+            size = -(-len(burst) // workers)
+            parts = [
+                burst[start:start + size]
+                for start in range(0, len(burst), size)]
+            futures = [
+                pool.submit(_convert_files, part) for part in parts]
+            broken = False
+            for part, future in zip(parts, futures):
+                try:
+                    results = future.result()
+                except Exception as e:
+                    broken = broken or isinstance(
+                        e, concurrent.futures.BrokenExecutor)
+                    results = [
+                        (input_file, [], e) for input_file, _ in part]
+                yield from results
+            if broken:
+                pool.shutdown(wait=False)
+                pool = concurrent.futures.ProcessPoolExecutor(jobs)
+    finally:
+        pool.shutdown()
+        watcher.close()
+
+
+def watch_main(argv):
+    """Entry point of watch mode.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='tbconv.py watch')
+    parser.add_argument(
+        'DIR',
+        help='Directory to watch for PRM files.',
+    )
+    parser.add_argument(
+        'OUT',
+        help='Directory to write converted files.',
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=None,
+        help='Number of worker processes. (default: number of CPUs)',
+    )
+    parser.add_argument(
+        '--debounce',
+        type=float,
+        default=0.2,
+        help='Seconds without change before a file is converted. '
+             '(default: 0.2)',
+    )
+    parser.add_argument(
+        '--poll',
+        action='store_true',
+        help='Poll the directory instead of using inotify.',
+    )
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.DIR):
+        print('No such directory: {}'.format(args.DIR))
+        return 1
+
+    print('Watching {}'.format(args.DIR), flush=True)
+    try:
+        for input_file, outputs, error in watch(
+                args.DIR, args.OUT, args.jobs, args.debounce, args.poll):
+            if error is None:
+                print('OK      {} -> {}'.format(
+                    input_file, ', '.join(outputs)), flush=True)
+            else:
+                print('FAILED  {}: {}'.format(input_file, error), flush=True)
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+# subdirectories of a work queue of distribute mode
+QUEUE_DIRS = ('todo', 'claimed', 'done')
+# file created in a work queue when workers are no longer needed
+QUEUE_FINISHED = 'finished'
+
+
+def worker_id():
+    """Return the name of this process as a worker of a work queue.
+    """
+    import socket
+
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def _write_json(path, value, suffix):
+    # atomically, through a temporary file of a name unique to the writer
+    import json
+
+    temp = '{}.{}.tmp'.format(path, suffix)
+    with open(temp, 'wt') as f:
+        json.dump(value, f)
+    os.replace(temp, path)
+
+
+def claim_unit(queue_dir, worker):
+    """Claim a work unit of queue_dir for worker.
+
+    A unit is claimed by renaming it from todo/ into claimed/, which only
+    one of workers racing for it can do. Return (unit, claim_file), or
+    None if no unit is left.
+    """
+    import random
+
+    todo = os.path.join(queue_dir, 'todo')
+    try:
+        names = [name for name in os.listdir(todo) if name.endswith('.json')]
+    except FileNotFoundError:
+        return None
+    # workers starting together do not race for the same unit
+    random.shuffle(names)
+    for name in names:
+        unit = name[:-len('.json')]
+        claim_file = os.path.join(
+            queue_dir, 'claimed', '{}.{}'.format(unit, worker))
+        try:
+            os.rename(os.path.join(todo, name), claim_file)
+        except FileNotFoundError:
+            continue
+        return unit, claim_file
+    return None
+
+
+def _work_unit(queue_dir, worker, unit, claim_file, cache=None):
+    # convert inputs of a claimed unit, and return None if the claim is
+    # lost to the coordinator as stale
+    import json
+
+    try:
+        with open(claim_file, 'rt') as f:
+            work_unit = json.load(f)
+    except FileNotFoundError:
+        return None
+    results = []
+    for input_file, output_file in zip(
+            work_unit['inputs'], work_unit['outputs']):
+        try:
+            # heartbeat
+            os.utime(claim_file)
+        except FileNotFoundError:
+            return None
+        try:
+            results.append(
+                [input_file, convert_file(input_file, output_file, cache),
+                 None])
+        except Exception as e:
+            results.append([input_file, [], str(e)])
+
+    _write_json(
+        os.path.join(queue_dir, 'done', unit + '.json'),
+        {'worker': worker, 'results': results},
+        worker)
+    _remove(claim_file)
+    return results
+
+
+def work(queue_dir, poll=1.0, cache=None, stop=None):
+    """Convert work units of queue_dir until it is finished.
+
+    Units are claimed one at a time with claim_unit(), and the queue is
+    polled every poll seconds while no unit is left. Yield (unit,
+    results) of each converted unit, where results is a list of
+    (input_file, output_files, error), until the coordinator finishes the
+    queue or stop.is_set() is true.
+    """
+    import time
+
+    worker = worker_id()
+    finished = os.path.join(queue_dir, QUEUE_FINISHED)
+    while stop is None or not stop.is_set():
+        claimed = claim_unit(queue_dir, worker)
+        if claimed is None:
+            if os.path.exists(finished):
+                return
+            time.sleep(poll)
+            continue
+        results = _work_unit(queue_dir, worker, *claimed, cache=cache)
+        if results is not None:
+            yield claimed[0], results
+
+
+def create_queue(input_files, output_dir, queue_dir, unit_size=100):
+    """Split input_files into units of unit_size files in todo/ of
+    queue_dir, to be converted into output_dir by workers (see work()).
+
+    Outputs are named as by output_files(). queue_dir must be empty, or
+    raise ValueError. Return a dict of unit: list of absolute input
+    files, in the order of input_files.
+    """
+    for name in QUEUE_DIRS:
+        os.makedirs(os.path.join(queue_dir, name), exist_ok=True)
+    if any(os.listdir(os.path.join(queue_dir, name)) for name in QUEUE_DIRS):
+        raise ValueError('Work queue is not empty: {}'.format(queue_dir))
+    _remove(os.path.join(queue_dir, QUEUE_FINISHED))
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = output_files(input_files, os.path.abspath(output_dir))
+
+    suffix = worker_id()
+    units = collections.OrderedDict()
+    for start in range(0, len(input_files), unit_size):
+        unit = '{:06d}'.format(len(units))
+        units[unit] = [
+            os.path.abspath(input_file)
+            for input_file in input_files[start:start + unit_size]]
+        _write_json(
+            os.path.join(queue_dir, 'todo', unit + '.json'),
+            {'inputs': units[unit],
+             'outputs': outputs[start:start + unit_size]},
+            suffix)
+    return units
+
+
+def finish_queue(queue_dir):
+    """Tell workers of queue_dir that it is finished, so that they exit.
+    """
+    with open(os.path.join(queue_dir, QUEUE_FINISHED), 'wt'):
+        pass
+
+
+def collect(queue_dir, units, stale=60.0, retries=3, poll=0.5, idle=600.0,
+            stop=None):
+    """Collect results of units of queue_dir given by create_queue().
+
+    A claim whose mtime, touched by its worker for each input, has not
+    changed for stale seconds of this clock is put back to todo/, up to
+    retries times. Units are given up if none is claimed or done for idle
+    seconds, as no worker is running.
+
+    Return a list of (input_file, output_files, error, worker) in the
+    order of units, where error is a string. The queue is finished when
+    all units are done or stop.is_set() is true, so that workers exit.
+    """
+    import json
+    import time
+
+    todo, claimed, done = (
+        os.path.join(queue_dir, name) for name in QUEUE_DIRS)
+    pending = set(units)
+    # input_file: (output_files, error, worker)
+    results = {}
+    requeued = collections.Counter()
+    # claim: (mtime, time the mtime was first seen)
+    heartbeats = {}
+    progress = time.monotonic()
+    try:
+        while pending and (stop is None or not stop.is_set()):
+            for name in os.listdir(done):
+                if not name.endswith('.json'):
+                    continue
+                unit = name[:-len('.json')]
+                path = os.path.join(done, name)
+                if unit in pending:
+                    with open(path, 'rt') as f:
+                        done_unit = json.load(f)
+                    for input_file, outputs, error in done_unit['results']:
+                        results[input_file] = (
+                            outputs, error, done_unit['worker'])
+                    pending.discard(unit)
+                    progress = time.monotonic()
+                    # put back as stale before it was done
+                    _remove(os.path.join(todo, unit + '.json'))
+                _remove(path)
+
+            now = time.monotonic()
+            claims = os.listdir(claimed)
+            if claims:
+                progress = now
+            for name in claims:
+                unit = name.split('.', 1)[0]
+                path = os.path.join(claimed, name)
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                seen = heartbeats.get(name)
+                if seen is None or seen[0] != mtime:
+                    heartbeats[name] = (mtime, now)
+                    continue
+                if now - seen[1] < stale:
+                    continue
+
+                del heartbeats[name]
+                if unit not in pending:
+                    _remove(path)
+                    continue
+                requeued[unit] += 1
+                if requeued[unit] > retries:
+                    _remove(path)
+                    pending.discard(unit)
+                    error = 'Claim went stale after {} retries.'.format(
+                        retries)
+                    for input_file in units[unit]:
+                        results[input_file] = ([], error, None)
+                    continue
+                try:
+                    os.rename(path, os.path.join(todo, unit + '.json'))
+                except FileNotFoundError:
+                    pass
+            heartbeats = dict(
+                (name, seen) for name, seen in heartbeats.items()
+                if name in claims)
+
+            if pending and now - progress >= idle:
+                error = 'No worker claimed the unit in {:g} seconds.'.format(
+                    idle)
+                for unit in sorted(pending):
+                    _remove(os.path.join(todo, unit + '.json'))
+                    for input_file in units[unit]:
+                        results[input_file] = ([], error, None)
+                pending.clear()
+
+            if pending:
+                time.sleep(poll)
+    finally:
+        finish_queue(queue_dir)
+
+    return [
+        (input_file,) + results.get(input_file, ([], 'Not converted.', None))
+        for input_files in units.values() for input_file in input_files]
+
+
+def distribute(input_files, output_dir, queue_dir, unit_size=100,
+               stale=60.0, retries=3, poll=0.5, idle=600.0, stop=None):
+    """Convert input_files into output_dir by workers of queue_dir.
+
+    The queue is made by create_queue() and its results are collected by
+    collect(). Return a list of (input_file, output_files, error, worker)
+    in input order, where error is a string.
+    """
+    units = create_queue(input_files, output_dir, queue_dir, unit_size)
+    return [
+        (input_file,) + result[1:]
+        for input_file, result in zip(input_files, collect(
+            queue_dir, units, stale, retries, poll, idle, stop))]
+
+
+def distribute_main(argv):
+    """Entry point of distribute mode.
+    """
+    import argparse
+    import subprocess
+
+    parser = argparse.ArgumentParser(prog='tbconv.py distribute')
+    parser.add_argument(
+        'INPUT',
+        help='Directory or glob pattern of files to convert.',
+    )
+    parser.add_argument(
+        'OUTPUT_DIR',
+        help='Directory to write converted files.',
+    )
+    parser.add_argument(
+        'QUEUE_DIR',
+        help='Shared directory of work units.',
+    )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=0,
+        help='Number of local worker processes to start. (default: 0)',
+    )
+    parser.add_argument(
+        '--unit-size',
+        type=int,
+        default=100,
+        help='Number of files in a work unit. (default: 100)',
+    )
+    parser.add_argument(
+        '--stale',
+        type=float,
+        default=60.0,
+        help='Seconds without heartbeat before a claimed unit is put '
+             'back. (default: 60)',
+    )
+    parser.add_argument(
+        '--retries',
+        type=int,
+        default=3,
+        help='Number of times a stale unit is put back. (default: 3)',
+    )
+    parser.add_argument(
+        '--idle',
+        type=float,
+        default=600.0,
+        help='Seconds without any unit claimed or done before the rest '
+             'are given up. (default: 600)',
+    )
+    args = parser.parse_args(argv)
+
+    input_files = find_inputs(args.INPUT)
+    if not input_files:
+        print('No input files: {}'.format(args.INPUT))
+        return 1
+
+    try:
+        units = create_queue(
+            input_files, args.OUTPUT_DIR, args.QUEUE_DIR, args.unit_size)
+    except (OSError, ValueError) as e:
+        print('Invalid work queue: {}'.format(e))
+        return 1
+
+    # started once the queue is ready, so that they do not see it finished
+    workers = []
+    try:
+        for _ in range(args.workers):
+            workers.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), 'worker',
+                 args.QUEUE_DIR],
+                stdout=subprocess.DEVNULL))
+        results = collect(
+            args.QUEUE_DIR, units, args.stale, args.retries, idle=args.idle)
+    finally:
+        finish_queue(args.QUEUE_DIR)
+        for worker in workers:
+            worker.wait()
+    results = [
+        (input_file,) + result[1:]
+        for input_file, result in zip(input_files, results)]
+
+    failed = 0
+    for input_file, outputs, error, worker in results:
+        if error is None:
+            print('OK      {} -> {}'.format(input_file, ', '.join(outputs)))
+        else:
+            failed += 1
+            print('FAILED  {}: {}'.format(input_file, error))
+    print('{} converted, {} failed by {} workers.'.format(
+        len(results) - failed, failed,
+        len(set(worker for _, _, _, worker in results) - {None})))
+
+    return 1 if failed else 0
+
+
+def worker_main(argv):
+    """Entry point of worker mode.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='tbconv.py worker')
+    parser.add_argument(
+        'QUEUE_DIR',
+        help='Shared directory of work units.',
+    )
+    parser.add_argument(
+        '--poll',
+        type=float,
+        default=1.0,
+        help='Seconds between polls of an empty queue. (default: 1)',
+    )
+    add_cache_arguments(parser)
+    args = parser.parse_args(argv)
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = get_cache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+    print('Worker {} on {}'.format(worker_id(), args.QUEUE_DIR), flush=True)
+    try:
+        for unit, results in work(args.QUEUE_DIR, args.poll, cache):
+            failed = sum(error is not None for _, _, error in results)
+            print('DONE    {}: {} converted, {} failed.'.format(
+                unit, len(results) - failed, failed), flush=True)
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+def _link(source, output_file):
+    # hard link, or copy where links are not supported
+    import shutil
+
+    _remove(output_file)
+    try:
+        os.link(source, output_file)
+    except OSError:
+        shutil.copyfile(source, output_file)
+
+
+def dedupe(input_files, output_dir):
+    """Convert input_files into output_dir, converting each unique pattern
+    once.
+
+    Outputs of a pattern with the same machine and fingerprint as an
+    earlier one are hard-linked to the earlier outputs. Return a list of
+    (input_file, output_files, error, original) in input order, where
+    original is the input file whose outputs were linked, or None.
+
+    Outputs are named as by output_files(), and an input some of whose
+    outputs have the name of an output of an earlier input fails, so
+    that no output is replaced by another.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    converted = {}
+    # output file: input file
+    written_by = {}
+    results = []
+    for input_file, output_file in zip(
+            input_files, output_files(input_files, output_dir)):
+        try:
+            pattern = Pattern.from_text(read_text(input_file))
+            key = (pattern.machine, pattern.fingerprint())
+            if key in converted:
+                original, outputs = converted[key]
+                names = output_names(output_file, len(outputs))
+            else:
+                out_lines = pattern.convert_lines()
+                names = output_names(output_file, len(out_lines))
+            for name in names:
+                if name in written_by:
+                    raise ValueError('{} is already written from {}.'.format(
+                        name, written_by[name]))
+            if key in converted:
+                for source, linked in zip(outputs, names):
+                    _link(source, linked)
+                written, original = names, original
+            else:
+                written = write_outputs(zip(names, out_lines))
+                converted[key] = (input_file, written)
+                original = None
+            written_by.update((name, input_file) for name in names)
+            results.append((input_file, written, None, original))
+        except (OSError, ValueError) as e:
+            results.append((input_file, [], e, None))
+
+    return results
+
+
+def dedupe_main(argv):
+    """Entry point of dedupe mode.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='tbconv.py dedupe')
+    parser.add_argument(
+        'INPUT',
+        help='Directory or glob pattern of files to convert.',
+    )
+    parser.add_argument(
+        'OUTPUT_DIR',
+        help='Directory to write converted files.',
+    )
+    args = parser.parse_args(argv)
+
+    input_files = find_inputs(args.INPUT)
+    if not input_files:
+        print('No input files: {}'.format(args.INPUT))
+        return 1
+
+    results = dedupe(input_files, args.OUTPUT_DIR)
+
+    converted = linked = failed = 0
+    saved = 0
+    for input_file, outputs, error, original in results:
+        if error is not None:
+            failed += 1
+            print('FAILED  {}: {}'.format(input_file, error))
+        elif original is None:
+            converted += 1
+            print('OK      {} -> {}'.format(input_file, ', '.join(outputs)))
+        else:
+            linked += 1
+            saved += sum(os.path.getsize(output) for output in outputs)
+            print('LINKED  {} -> {} (same as {})'.format(
+                input_file, ', '.join(outputs), original))
+    print('{} converted, {} linked, {} failed.'.format(
+        converted, linked, failed))
+    print('Saved {} conversions and {:,} bytes.'.format(linked, saved))
+
+    return 1 if failed else 0
+
+
+def _merge_group(input_files, output_file):
+    # merge TB-03 patterns split from one pattern, or return None
+    patterns = [Pattern.from_text(read_text(f)) for f in input_files]
+    if any(pattern.machine != Machine.TB03 for pattern in patterns):
+        return None
+    if any(pattern.length != CHUNK_STEPS - 1 for pattern in patterns[:-1]):
+        return None
+    return write_outputs(zip(
+        [output_file], Pattern.merge(patterns).convert_lines()))
+
+
+def merge(input_files, output_dir, naming=Naming()):
+    """Convert input_files into output_dir, merging TB-03 files split from
+    one TB-3 pattern back into one file.
+
+    Files are merged if naming gives them one output file and indices
+    from the first, all but the last have 16 steps, and no other input
+    file has the name of the output file. Other files are converted one
+    by one. Return a list of (input_files, output_files, error).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # (output_name, None) of a group, or (None, input_file) of a file
+    # naming does not parse: [(index, input_file)]
+    groups = collections.OrderedDict()
+    unsplit = set()
+    for input_file in input_files:
+        name = os.path.basename(input_file)
+        parsed = naming.parse(name)
+        if parsed is None:
+            groups[None, input_file] = [(0, input_file)]
+            unsplit.add(name)
+        else:
+            groups.setdefault((parsed[0], None), []).append(
+                (parsed[1], input_file))
+
+    results = []
+    for (output_name, _), members in groups.items():
+        members.sort()
+        group = [input_file for _, input_file in members]
+        if (output_name is not None and output_name not in unsplit
+                and len(group) > 1
+                and [index for index, _ in members] == list(
+                    range(len(group)))):
+            try:
+                written = _merge_group(
+                    group, os.path.join(output_dir, output_name))
+            except (OSError, ValueError) as e:
+                results.append((group, [], e))
+                continue
+            if written is not None:
+                results.append((group, written, None))
+                continue
+
+        for input_file in group:
+            try:
+                written = convert_file(input_file, os.path.join(
+                    output_dir, os.path.basename(input_file)))
+                results.append(([input_file], written, None))
+            except (OSError, ValueError) as e:
+                results.append(([input_file], [], e))
+
+    return results
+
+
+def merge_main(argv):
+    """Entry point of merge mode.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='tbconv.py merge')
+    parser.add_argument(
+        'INPUT',
+        help='Directory or glob pattern of files to convert.',
+    )
+    parser.add_argument(
+        'OUTPUT_DIR',
+        help='Directory to write converted files.',
+    )
+    parser.add_argument(
+        '--naming',
+        default='{root}{letter}{ext}',
+        help='Names of files split from one pattern, with {root}, {ext} '
+             'and {letter} or {number}. (default: {root}{letter}{ext})',
+    )
+    args = parser.parse_args(argv)
+
+    input_files = find_inputs(args.INPUT)
+    if not input_files:
+        print('No input files: {}'.format(args.INPUT))
+        return 1
+
+    merged = converted = failed = 0
+    for group, outputs, error in merge(
+            input_files, args.OUTPUT_DIR, Naming(args.naming)):
+        if error is not None:
+            failed += 1
+            print('FAILED  {}: {}'.format(', '.join(group), error))
+            continue
+        if len(group) > 1:
+            merged += 1
+        else:
+            converted += 1
+        print('OK      {} -> {}'.format(', '.join(group), ', '.join(outputs)))
+    print('{} merged, {} converted, {} failed.'.format(
+        merged, converted, failed))
+
+    return 1 if failed else 0
+
+
+# notes accepted by validate_text(), as MIDI note numbers
+NOTE_RANGE = range(0, 128)
+
+
+@functools.lru_cache(maxsize=None)
+def _validation_rules(machine):
+    # (rules, steps, fields, valid params of a step) of machine, where
+    # rules is a list of (regex of line, kind), compiled on first use
+    import re
+
+    number = r'\s*(-?\d+)\s*'
+    if machine == Machine.TB3:
+        steps = 32
+        # STEPn(note,slide,state,accent);
+        fields = ('note', 'slide', 'state', 'accent')
+        rules = [
+            (re.compile(r'STEP(\d+)\({}\);'.format(
+                ','.join([number] * 4))), 'step'),
+            (re.compile(r'TRIPLET\({}\);'.format(number)), 'triplet'),
+            (re.compile(r'LAST_STEP\({}\);'.format(number)), 'length'),
+            (re.compile(r'(?:GATE_WIDTH|BANK|PATCH)\({}\);'.format(number)),
+             None),
+        ]
+    else:
+        steps = 16
+        # STEP n\t= STATE=s NOTE=n ACCENT=a SLIDE=s, split by whitespace
+        # as read_params() does
+        fields = ('state', 'note', 'accent', 'slide')
+        rules = [
+            (re.compile(
+                r'STEP (\d+)\s+=\s+STATE={0}\s+NOTE={0}\s+ACCENT={0}'
+                r'\s+SLIDE={0}'.format(r'(-?\d+)')), 'step'),
+            (re.compile(r'END_STEP\s*={}'.format(number)), 'length'),
+            (re.compile(r'TRIPLET\s*={}'.format(number)), 'triplet'),
+        ]
+
+    # every valid combination, so that a valid step is checked at once
+    valid = set()
+    for note in NOTE_RANGE:
+        for flags in itertools.product('01', repeat=3):
+            flags = iter(flags)
+            valid.add(tuple(
+                str(note) if field == 'note' else next(flags)
+                for field in fields))
+    return rules, steps, fields, valid
+
+
+def validate_text(text):
+    """Check that text is a well formed PRM file.
+
+    Return a list of (line_number, problem), empty if the file is valid.
+    """
+    lines = text.splitlines()
+    machine = get_machine_type(lines[0] if lines else '')
+    if machine == Machine.UNKNOWN:
+        return [(1, 'Unknown file type')]
+
+    rules, steps, fields, valid = _validation_rules(machine)
+    length_name = 'LAST_STEP' if machine == Machine.TB3 else 'END_STEP'
+    problems = []
+    found = set()
+    indices = set()
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        for regex, kind in rules:
+            match = regex.fullmatch(line)
+            if match is not None:
+                break
+        else:
+            problems.append((number, 'Malformed line: {!r}'.format(line)))
+            continue
+
+        if kind == 'step':
+            index, *params = match.groups()
+            index = int(index)
+            if not 1 <= index <= steps:
+                problems.append((number, 'Step out of range 1..{}: {}'.format(
+                    steps, index)))
+            elif index in indices:
+                problems.append((number, 'Duplicate step: {}'.format(index)))
+            indices.add(index)
+            if tuple(params) in valid:
+                continue
+            for field, value in zip(fields, map(int, params)):
+                if field == 'note':
+                    if value not in NOTE_RANGE:
+                        problems.append((
+                            number, 'Note out of range {}..{}: {}'.format(
+                                NOTE_RANGE[0], NOTE_RANGE[-1], value)))
+                elif value not in (0, 1):
+                    problems.append((number, '{} must be 0 or 1: {}'.format(
+                        field.capitalize(), value)))
+            continue
+
+        found.add(kind)
+        value = int(match.group(1))
+        if kind == 'length':
+            if not 0 <= value < steps:
+                problems.append((number, '{} out of range 0..{}: {}'.format(
+                    length_name, steps - 1, value)))
+        elif kind == 'triplet':
+            if value not in (0, 1):
+                problems.append((number, 'TRIPLET must be 0 or 1: {}'.format(
+                    value)))
+
+    for kind, name in (('length', length_name), ('triplet', 'TRIPLET')):
+        if kind not in found:
+            problems.append((None, 'Missing {}'.format(name)))
+    return problems
+
+
+def validate_file(input_file):
+    """Check that input_file is a well formed PRM file.
+
+    Return a list of (input_file, line_number, problem).
+    """
+    try:
+        text = read_text(input_file)
+    except (OSError, UnicodeDecodeError) as e:
+        return [(input_file, None, str(e))]
+    return [
+        (input_file, number, problem)
+        for number, problem in validate_text(text)
+    ]
+
+
+def validate(input_files, jobs=None, fail_fast=False):
+    """Yield (input_file, line_number, problem) of input_files, checked
+    with a process pool unless jobs is 1.
+
+    With fail_fast, stop after the problems of the first invalid file.
+    """
+    if jobs == 1:
+        for input_file in input_files:
+            problems = validate_file(input_file)
+            yield from problems
+            if problems and fail_fast:
+                return
+        return
+
+    import concurrent.futures
+
+    pool = concurrent.futures.ProcessPoolExecutor(jobs)
+    try:
+        for problems in pool.map(validate_file, input_files, chunksize=64):
+            yield from problems
+            if problems and fail_fast:
+                return
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def validate_main(argv):
+    """Entry point of validate mode.
+    """
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(prog='tbconv.py validate')
+    parser.add_argument(
+        'INPUT',
+        nargs='+',
+        help='Files, directories or glob patterns of PRM files.',
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=None,
+        help='Number of worker processes. (default: number of CPUs)',
+    )
+    parser.add_argument(
+        '-x', '--fail-fast',
+        action='store_true',
+        help='Stop at the first invalid file.',
+    )
+    args = parser.parse_args(argv)
+
+    input_files = []
+    for source in args.INPUT:
+        input_files.extend(find_inputs(source) or [source])
+
+    invalid = set()
+    for input_file, number, problem in validate(
+            input_files, args.jobs, args.fail_fast):
+        invalid.add(input_file)
+        print(json.dumps(
+            {'file': input_file, 'line': number, 'problem': problem}),
+            flush=True)
+    if args.fail_fast and invalid:
+        print('Stopped at the first invalid file.', file=sys.stderr)
+    else:
+        print('{} files checked, {} invalid.'.format(
+            len(input_files), len(invalid)), file=sys.stderr)
+
+    return 1 if invalid else 0
+
+
+HTTP_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+# largest body of a request, far more than any PRM file
+HTTP_MAX_BODY = 1024 * 1024
+
+
+def http_response(status, body=b'', headers=()):
+    """Return bytes of an HTTP/1.1 response.
+    """
+    lines = ['HTTP/1.1 {} {}'.format(status, HTTP_REASONS[status])]
+    lines.append('Content-Type: text/plain; charset=ascii')
+    lines.append('Content-Length: {}'.format(len(body)))
+    lines.extend('{}: {}'.format(key, value) for key, value in headers)
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+def _is_file_name(name):
+    # printable ASCII without path separators, safe in a header
+    return (name.isascii() and name.isprintable()
+            and '/' not in name and '\\' not in name)
+
+
+async def handle_http(reader, writer, executor):
+    """Serve conversion requests on one connection.
+
+    POST /convert?name=NAME with a PRM file as the body returns the
+    converted file(s) as a stream separated by STREAM_DELIMITER, and
+    their names in the X-Tbconv-Files header. A body over HTTP_MAX_BODY
+    bytes and a NAME other than a printable ASCII file name are rejected,
+    and a file failing conversion is a bad request. A broken executor is
+    answered with 503, and other failures with 500.
+    """
+    import asyncio
+    import concurrent.futures
+    import urllib.parse
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+
+            try:
+                method, target, _ = request_line.decode('latin-1').split()
+                length = int(headers.get('content-length', 0))
+                if length < 0:
+                    raise ValueError(length)
+            except ValueError:
+                writer.write(http_response(400, b'Bad request.\n'))
+                break
+            if length > HTTP_MAX_BODY:
+                writer.write(http_response(413, b'Too large.\n'))
+                break
+            body = await reader.readexactly(length)
+
+            path, _, query = target.partition('?')
+            if path != '/convert':
+                response = http_response(404, b'Not found.\n')
+            elif method != 'POST':
+                response = http_response(405, b'Use POST.\n')
+            else:
+                name = urllib.parse.parse_qs(query).get(
+                    'name', ['output.prm'])[0]
+                try:
+                    if not _is_file_name(name):
+                        raise ValueError('Invalid name.')
+                    outputs = await asyncio.wrap_future(
+                        executor.submit(convert_bytes, body, name),
+                        loop=loop)
+                except ValueError as e:
+                    response = http_response(
+                        400, '{}\n'.format(e).encode('ascii', 'replace'))
+                except concurrent.futures.BrokenExecutor:
+                    response = http_response(503, b'Try again.\n')
+                except Exception:
+                    response = http_response(500, b'Conversion failed.\n')
+                else:
+                    response = http_response(
+                        200,
+                        (STREAM_DELIMITER + '\n').encode('ascii').join(
+                            data for _, data in outputs),
+                        [('X-Tbconv-Files',
+                          ', '.join(output for output, _ in outputs))],
+                    )
+
+            writer.write(response)
+            await writer.drain()
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(executor, host='127.0.0.1', port=8080, path=None):
+    """Start the conversion server on TCP host:port, or Unix socket path.
+    """
+    import asyncio
+
+    handler = functools.partial(handle_http, executor=executor)
+    if path is not None:
+        return await asyncio.start_unix_server(handler, path)
+    return await asyncio.start_server(handler, host, port)
+
+
+class RenewingPool(object):
+    """Process pool replaced by a new one once a dead worker process has
+    broken it, so that later tasks are run again.
+    """
+    def __init__(self, max_workers=None):
+        import concurrent.futures
+
+        self.max_workers = max_workers
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def submit(self, fn, *args, **kwargs):
+        import concurrent.futures
+
+        try:
+            return self.pool.submit(fn, *args, **kwargs)
+        except concurrent.futures.BrokenExecutor:
+            self.pool.shutdown(wait=False)
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                self.max_workers)
+            return self.pool.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait)
+
+
+def serve(host='127.0.0.1', port=8080, path=None, jobs=None):
+    """Run the conversion server until interrupted.
+    """
+    import asyncio
+
+    async def run(executor):
+        server = await start_server(executor, host, port, path)
+        for sock in server.sockets:
+            print('Serving on {}'.format(sock.getsockname()))
+        async with server:
+            await server.serve_forever()
+
+    with RenewingPool(max_workers=jobs) as executor:
+        try:
+            asyncio.run(run(executor))
+        except KeyboardInterrupt:
+            pass
+
+
+def serve_main(argv):
+    """Entry point of serve mode.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='tbconv.py serve')
+    parser.add_argument(
+        '--host',
+        default='127.0.0.1',
+        help='Host to listen on. (default: 127.0.0.1)',
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8080,
+        help='Port to listen on. (default: 8080)',
+    )
+    parser.add_argument(
+        '--unix',
+        default=None,
+        help='Listen on this Unix socket instead of TCP.',
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=None,
+        help='Number of worker processes. (default: number of CPUs)',
+    )
+    args = parser.parse_args(argv)
+
+    serve(args.host, args.port, args.unix, args.jobs)
+    return 0
+
+
+def pack_main(argv):
+    """Entry point of pack mode.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='tbconv.py pack')
+    parser.add_argument(
+        'STORE',
+        help='Pattern store to append patterns to.',
+    )
+    parser.add_argument(
+        'INPUT',
+        nargs='+',
+        help='Files, directories or glob patterns of PRM files, or '
+             'archives of concatenated PRM files.',
+    )
+    args = parser.parse_args(argv)
+
+    failed = 0
+    with PatternStore(args.STORE, 'a') as store:
+        for source in args.INPUT:
+            for input_file in find_inputs(source) or [source]:
+                # all patterns of a file are read before any is packed
+                try:
+                    patterns = [
+                        Pattern.from_buffer(chunk)
+                        for chunk in iter_archive(input_file)]
+                    if not patterns:
+                        raise ValueError('Invalid file type.')
+                except (OSError, ValueError) as e:
+                    failed += 1
+                    print('FAILED  {}: {}'.format(input_file, e))
+                    continue
+                for pattern in patterns:
+                    index = store.append(pattern)
+                    print('{:>7} {}'.format(index, input_file))
+        count = len(store)
+    print('{} patterns in {}, {} failed.'.format(count, args.STORE, failed))
+
+    return 1 if failed else 0
+
+
+def unpack_main(argv):
+    """Entry point of unpack mode.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='tbconv.py unpack')
+    parser.add_argument(
+        'STORE',
+        help='Pattern store to read.',
+    )
+    parser.add_argument(
+        'OUTPUT_DIR',
+        help='Directory to write PRM files.',
+    )
+    parser.add_argument(
+        '-f', '--format',
+        choices=['tb3', 'tb03', 'converted'],
+        default='converted',
+        help='Format of PRM files. "converted" is the format of the other '
+             'machine of each pattern. (default: converted)',
+    )
+    parser.add_argument(
+        '-i', '--index',
+        type=int,
+        action='append',
+        help='Index of pattern to write. (default: all patterns)',
+    )
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.OUTPUT_DIR, exist_ok=True)
+    failed = 0
+    with PatternStore(args.STORE) as store:
+        indices = args.index if args.index else range(len(store))
+        for index in indices:
+            if index < 0:
+                index += len(store)
+            try:
+                pattern = store[index]
+            except IndexError:
+                failed += 1
+                print('FAILED  {}: No such pattern in {} of {} '
+                      'patterns.'.format(index, args.STORE, len(store)))
+                continue
+            if args.format == 'tb3':
+                out_texts = [pattern.to_tb3()]
+            elif args.format == 'tb03':
+                out_texts = pattern.to_tb03()
+            else:
+                out_texts = pattern.convert()
+            output_file = os.path.join(
+                args.OUTPUT_DIR, 'PTN{:05d}.PRM'.format(index))
+            written = write_outputs(
+                zip(output_names(output_file, len(out_texts)), out_texts))
+            print('{:>7} {}'.format(index, ', '.join(written)))
+
+    return 1 if failed else 0
+
+
+def index_main(argv):
+    """Entry point of index mode.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='tbconv.py index')
+    parser.add_argument(
+        'LIBRARY',
+        help='Pattern library database to update.',
+    )
+    parser.add_argument(
+        'INPUT',
+        nargs='+',
+        help='Files, directories or glob patterns of PRM files, or '
+             'archives of concatenated PRM files.',
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=None,
+        help='Number of worker processes. (default: number of CPUs)',
+    )
+    args = parser.parse_args(argv)
+
+    with PatternLibrary(args.LIBRARY) as library:
+        indexed, unchanged, removed, failed = library.update(
+            args.INPUT, jobs=args.jobs)
+    for input_file, error in failed:
+        print('FAILED  {}: {}'.format(input_file, error))
+    print('{} indexed, {} unchanged, {} removed, {} failed.'.format(
+        indexed, unchanged, removed, len(failed)))
+
+    return 1 if failed else 0
+
+
+def search_main(argv):
+    """Entry point of search mode.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='tbconv.py search')
+    parser.add_argument(
+        'LIBRARY',
+        help='Pattern library database built by "tbconv.py index".',
+    )
+    for name in ('step', 'note', 'state', 'slide', 'accent'):
+        parser.add_argument(
+            '--' + name,
+            type=int,
+            default=None,
+            help='{} of a matching step.'.format(name.capitalize()),
+        )
+    parser.add_argument(
+        '--duplicates',
+        action='store_true',
+        help='List groups of patterns with the same fingerprint.',
+    )
+    parser.add_argument(
+        '--similar',
+        metavar='FILE',
+        default=None,
+        help='List patterns similar to a pattern of an indexed file.',
+    )
+    parser.add_argument(
+        '--position',
+        type=int,
+        default=0,
+        help='Position of the pattern in the file of --similar. '
+             '(default: 0)',
+    )
+    parser.add_argument(
+        '--max-diff',
+        type=int,
+        default=1,
+        help='Number of different steps allowed by --similar. (default: 1)',
+    )
+    args = parser.parse_args(argv)
+
+    with PatternLibrary(args.LIBRARY) as library:
+        if args.duplicates:
+            groups = library.duplicates()
+            for group in groups:
+                print(' '.join(
+                    '{}:{}'.format(path, position)
+                    for path, position in group))
+            print('{} groups of duplicates.'.format(len(groups)))
+            return 0
+
+        if args.similar is not None:
+            matches = library.similar(
+                args.similar, args.position, args.max_diff)
+            for path, position, diff in matches:
+                print('{:>3} {}:{}'.format(diff, path, position))
+        else:
+            matches = library.search(
+                args.step, args.note, args.state, args.slide, args.accent)
+            for path, position in matches:
+                print('{}:{}'.format(path, position))
+    print('{} patterns found.'.format(len(matches)))
+
+    return 0
+
+
+COMMANDS = {
+    'batch': batch_main,
+    'dedupe': dedupe_main,
+    'distribute': distribute_main,
+    'index': index_main,
+    'merge': merge_main,
+    'pack': pack_main,
+    'search': search_main,
+    'serve': serve_main,
+    'sync': sync_main,
+    'unpack': unpack_main,
+    'validate': validate_main,
+    'watch': watch_main,
+    'worker': worker_main,
+}
+
+
+def fast_args(argv):
+    """Parse the common "INPUT_FILE OUTPUT_FILE [-p]" without argparse.
+
+    Return (input_file, output_file, verbose), or None for other argv.
+    """
+    files = [arg for arg in argv if arg not in ('-p', '--print')]
+    if len(files) != 2 or files[0] in COMMANDS:
+        return None
+    if any(arg.startswith('-') for arg in files):
+        return None
+    return files[0], files[1], len(files) != len(argv)
+
+
+def cli(argv):
+    """Command line entry point.
+    """
+    global FSYNC, VERBOSE
+
+    args = fast_args(argv)
+    if args is not None:
+        input_file, output_file, VERBOSE = args
+        return main(input_file, output_file)
+
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'INPUT_FILE',
+        help='File to convert. (- for stdin)',
+    )
+    parser.add_argument(
+        'OUTPUT_FILE',
+        help='The result of file conversion. (- for stdout)',
+    )
+    parser.add_argument(
+        '-p', '--print',
+        action='store_true',
+        dest='verbose',
+        help='Print input and output file.',
+    )
+    parser.add_argument(
+        '-b', '--bank-size',
+        type=int,
+        default=1,
+        help='Number of patterns converted at once with NumPy in stream '
+             'mode. (default: 1)',
+    )
+    parser.add_argument(
+        '--fsync',
+        action='store_true',
+        help='fsync output files and their directory.',
+    )
+    add_cache_arguments(parser)
+    add_stats_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.bank_size < 1:
+        parser.error('argument -b/--bank-size: must be at least 1')
+
+    input_file = args.INPUT_FILE
+    output_file = args.OUTPUT_FILE
+    VERBOSE = args.verbose
+    FSYNC = args.fsync
+
+    if input_file == '-' or output_file == '-':
+        return stream_main(input_file, output_file, args.bank_size)
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = ConversionCache(
+            directory=args.cache_dir,
+            max_bytes=args.cache_size * 1024 * 1024)
+
+    status = instrumented(args, main, input_file, output_file, cache)
+
+    if cache is not None:
+        print_cache(cache)
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(cli(sys.argv[1:]))
@@ -114,6 +114,20 @@ class ParamsMixin(object):
         return Machine
 
 
+class TestLookup(object):
+    """Test for _Lookup
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv._Lookup
+
+    def test_max_keys(self, target):
+        ints = target(int, max_keys=2)
+        assert [ints[key] for key in ('1', '01', '001', '1')] == [1, 1, 1, 1]
+        assert sorted(ints) == ['01', '1']
+
+
 class TestReadParam(ParamsMixin):
     """Test for read_param()
     """
@@ -218,6 +232,22 @@ class TestReadParam(ParamsMixin):
             0, 0, 0, 0, 0, 0, 0, 0,
         ]
 
+    @pytest.mark.parametrize('line', [
+        'STEP33(48,0,1,0);',
+        'STEP0(48,0,1,0);',
+        'STEP 33	= STATE=1 NOTE=48 ACCENT=0 SLIDE=0',
+    ])
+    def test_invalid_step(self, target, line):
+        machine = self.machine.UNKNOWN
+
+        with pytest.raises(ValueError):
+            target(
+                line, machine,
+                note=self.note, state=self.state,
+                slide=self.slide, accent=self.accent,
+            )
+        assert self.note == [24] * 32
+
 
 class TestWriteParams(ParamsMixin):
     """Test for wrtie_params()
@@ -241,10 +271,13 @@ class TestWriteParams(ParamsMixin):
         assert m.called is False
 
     def test_tb3_length_16(self, target):
+        from os import getpid
+
         machine = self.machine.TB3
 
         m = mock.mock_open()
-        with mock.patch('tbconv.open', m):
+        with mock.patch('tbconv.open', m), \
+                mock.patch('tbconv.os.replace') as m_replace:
             target(
                 machine,
                 self.output_file,
@@ -257,10 +290,12 @@ class TestWriteParams(ParamsMixin):
         assert m.call_count == 2
 
         args, kwargs = m.call_args_list[0]
-        assert args == ('output_01a.prm', 'wt')
+        assert args == ('output_01a.prm.{}.tmp'.format(getpid()), 'wt')
+        m_replace.assert_any_call(args[0], 'output_01a.prm')
 
         args, kwargs = m.call_args_list[1]
-        assert args == ('output_01b.prm', 'wt')
+        assert args == ('output_01b.prm.{}.tmp'.format(getpid()), 'wt')
+        m_replace.assert_any_call(args[0], 'output_01b.prm')
 
         handle = m()
         args, kwargs = handle.write.call_args_list[0]
@@ -310,11 +345,14 @@ class TestWriteParams(ParamsMixin):
         assert kwargs == {}
 
     def test_tb3_length_15(self, target):
+        from os import getpid
+
         machine = self.machine.TB3
         length = 15
 
         m = mock.mock_open()
-        with mock.patch('tbconv.open', m):
+        with mock.patch('tbconv.open', m), \
+                mock.patch('tbconv.os.replace') as m_replace:
             target(
                 machine,
                 self.output_file,
@@ -327,7 +365,8 @@ class TestWriteParams(ParamsMixin):
         assert m.call_count == 1
 
         args, kwargs = m.call_args_list[0]
-        assert args == ('output_01.prm', 'wt')
+        assert args == ('output_01.prm.{}.tmp'.format(getpid()), 'wt')
+        m_replace.assert_any_call(args[0], 'output_01.prm')
 
         handle = m()
         args, kwargs = handle.write.call_args_list[0]
@@ -354,11 +393,14 @@ class TestWriteParams(ParamsMixin):
         assert kwargs == {}
 
     def test_tb3_length_14(self, target):
+        from os import getpid
+
         machine = self.machine.TB3
         length = 14
 
         m = mock.mock_open()
-        with mock.patch('tbconv.open', m):
+        with mock.patch('tbconv.open', m), \
+                mock.patch('tbconv.os.replace') as m_replace:
             target(
                 machine,
                 self.output_file,
@@ -371,7 +413,8 @@ class TestWriteParams(ParamsMixin):
         assert m.call_count == 1
 
         args, kwargs = m.call_args_list[0]
-        assert args == ('output_01.prm', 'wt')
+        assert args == ('output_01.prm.{}.tmp'.format(getpid()), 'wt')
+        m_replace.assert_any_call(args[0], 'output_01.prm')
 
         handle = m()
         args, kwargs = handle.write.call_args_list[0]
@@ -398,11 +441,14 @@ class TestWriteParams(ParamsMixin):
         assert kwargs == {}
 
     def test_tb03_length_16(self, target):
+        from os import getpid
+
         machine = self.machine.TB03
         length = 16
 
         m = mock.mock_open()
-        with mock.patch('tbconv.open', m):
+        with mock.patch('tbconv.open', m), \
+                mock.patch('tbconv.os.replace') as m_replace:
             target(
                 machine,
                 self.output_file,
@@ -415,7 +461,8 @@ class TestWriteParams(ParamsMixin):
         assert m.call_count == 1
 
         args, kwargs = m.call_args_list[0]
-        assert args == ('output_01.prm', 'wt')
+        assert args == ('output_01.prm.{}.tmp'.format(getpid()), 'wt')
+        m_replace.assert_any_call(args[0], 'output_01.prm')
 
         handle = m()
         handle.write.assert_called_once_with(
@@ -479,3 +526,1748 @@ class TestMain(ParamsMixin):
         captured = capsys.readouterr()
         assert captured.out == 'No such file: input_01.prm\n'
         assert captured.err == ''
+
+
+class TestBatch(object):
+    """Test for batch()
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv.batch
+
+    @pytest.fixture
+    def samples(self):
+        import os.path
+        return os.path.join(os.path.dirname(__file__), '..', 'samples')
+
+    def test_convert_directory(self, tmp_path, target, samples):
+        from tbconv import find_inputs
+
+        input_files = find_inputs(samples)
+        results = target(input_files, str(tmp_path), jobs=2)
+
+        assert [r[0] for r in results] == input_files
+        assert [r[2] for r in results] == [None, None]
+        assert sorted(p.name for p in tmp_path.iterdir()) == [
+            'TB03_PTN1_01.PRM',
+            'TB3_PTN1.PRM',
+        ]
+
+    def test_invalid_file(self, tmp_path, target):
+        input_file = tmp_path / 'broken.prm'
+        input_file.write_text('hoge\n')
+
+        results = target([str(input_file)], str(tmp_path / 'out'), jobs=1)
+
+        assert len(results) == 1
+        assert results[0][1] == []
+        assert isinstance(results[0][2], ValueError)
+
+    def test_same_names(self, tmp_path, target, samples):
+        import os.path
+        import shutil
+
+        for name in ('a', 'b'):
+            (tmp_path / name).mkdir()
+        shutil.copy(os.path.join(samples, 'TB3_PTN1.PRM'),
+                    str(tmp_path / 'a' / 'P.PRM'))
+        shutil.copy(os.path.join(samples, 'TB03_PTN1_01.PRM'),
+                    str(tmp_path / 'b' / 'P.PRM'))
+        output_dir = tmp_path / 'out'
+
+        results = target(
+            [str(tmp_path / 'a' / 'P.PRM'), str(tmp_path / 'b' / 'P.PRM')],
+            str(output_dir), jobs=1)
+
+        assert [outputs for _, outputs, _, _ in results] == [
+            [str(output_dir / 'a' / 'P.PRM')],
+            [str(output_dir / 'b' / 'P.PRM')],
+        ]
+        assert (output_dir / 'a' / 'P.PRM').read_text().startswith('END_')
+        assert (output_dir / 'b' / 'P.PRM').read_text().startswith('TRIP')
+
+    def test_main(self, tmp_path, capsys, samples):
+        from tbconv import batch_main
+
+        assert batch_main(
+            [samples, str(tmp_path), '--jobs', '1', '--fsync']) == 0
+        assert capsys.readouterr().out.endswith('2 converted, 0 failed.\n')
+
+
+class TestPattern(object):
+    """Test for Pattern
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv.Pattern
+
+    @property
+    def machine(self):
+        from tbconv import Machine
+        return Machine
+
+    def test_invalid_step(self, target):
+        with pytest.raises(ValueError, match='Invalid step 33'):
+            target.from_text(
+                'TRIPLET(0);\nLAST_STEP(1);\nSTEP33(48,0,1,0);\n')
+
+    @property
+    def tb3_text(self):
+        return (
+            'TRIPLET(1);\n'
+            'LAST_STEP(20);\n'
+            'GATE_WIDTH(70);\n'
+            'STEP1(51,1,1,1);\n'
+            'STEP2(48,0,0,1);\n'
+            'STEP18(60,1,0,0);\n'
+            'BANK(-1);\n'
+            'PATCH(0);\n'
+        )
+
+    def test_slots(self, target):
+        pattern = target(self.machine.TB3)
+        assert not hasattr(pattern, '__dict__')
+        assert len(pattern.steps) == 4 * target.STEPS
+
+    def test_from_text(self, target):
+        pattern = target.from_text(self.tb3_text)
+
+        assert pattern.machine == self.machine.TB3
+        assert pattern.length == 20
+        assert pattern.triplet == 1
+        assert list(pattern.note[:3]) == [51, 48, 24]
+        assert list(pattern.slide[:3]) == [1, 0, 0]
+        assert list(pattern.state[:3]) == [0, 1, 0]
+        assert list(pattern.accent[:3]) == [1, 1, 0]
+        assert pattern.note[17] == 60
+
+    def test_unknown(self, target):
+        with pytest.raises(ValueError):
+            target.from_text('LAST_STEP(15);\n')
+
+    def test_to_tb3(self, target):
+        pattern = target.from_text(self.tb3_text)
+
+        assert target.from_text(pattern.to_tb3()) == pattern
+
+    def test_to_tb03(self, target):
+        pattern = target.from_text(self.tb3_text)
+
+        texts = pattern.to_tb03()
+        assert len(texts) == 2
+        assert texts[0].startswith('END_STEP\t= 15\nTRIPLET\t= 1\n')
+        assert texts[1].startswith('END_STEP\t= 4\nTRIPLET\t= 1\n')
+        assert 'STEP 2\t= STATE=1 NOTE=60 ACCENT=0 SLIDE=1\n' in texts[1]
+        assert pattern.convert() == texts
+
+        converted = target.from_text(texts[0])
+        assert converted.machine == self.machine.TB03
+        assert converted.to_tb3().splitlines()[3:5] == [
+            'STEP1(51,1,1,1);',
+            'STEP2(48,0,0,1);',
+        ]
+
+    def test_fingerprint(self, target):
+        pattern = target.from_text(
+            self.tb3_text.replace('LAST_STEP(20)', 'LAST_STEP(15)'))
+        converted = target.from_text(pattern.to_tb03()[0])
+        assert converted.machine == self.machine.TB03
+        assert converted.fingerprint() == pattern.fingerprint()
+
+        unused = target.from_text(pattern.to_tb3())
+        unused.note[20] = 60
+        assert unused.fingerprint() == pattern.fingerprint()
+
+        used = target.from_text(pattern.to_tb3())
+        used.note[15] = 60
+        assert used.fingerprint() != pattern.fingerprint()
+
+
+class TestConvertText(object):
+    """Test for convert_text() and convert_bytes()
+    """
+    @property
+    def tb03_text(self):
+        return (
+            'END_STEP\t= 1\n'
+            'TRIPLET\t= 0\n'
+            'STEP 1\t= STATE=1 NOTE=50 ACCENT=0 SLIDE=1\n'
+            'STEP 2\t= STATE=0 NOTE=28 ACCENT=1 SLIDE=0\n'
+        )
+
+    def test_convert_text(self):
+        from tbconv import convert_text
+
+        m = mock.mock_open()
+        with mock.patch('tbconv.open', m):
+            outputs = convert_text(self.tb03_text, 'out.prm')
+
+        assert m.called is False
+        assert len(outputs) == 1
+        name, text = outputs[0]
+        assert name == 'out.prm'
+        assert text.startswith(
+            'TRIPLET(0);\n'
+            'LAST_STEP(1);\n'
+            'GATE_WIDTH(67);\n'
+            'STEP1(50,1,0,0);\n'
+            'STEP2(28,0,1,1);\n'
+            'STEP3(24,0,0,0);\n'
+        )
+
+    def test_convert_text_split(self):
+        from tbconv import convert_text
+
+        text = 'TRIPLET(0);\nLAST_STEP(31);\n'
+        outputs = convert_text(text, 'out.prm')
+
+        assert [name for name, text in outputs] == ['outa.prm', 'outb.prm']
+
+    def test_convert_text_unknown(self):
+        from tbconv import convert_text
+
+        with pytest.raises(ValueError):
+            convert_text('hoge\n')
+
+    def test_convert_bytes(self):
+        import io
+        from tbconv import convert_bytes, convert_text
+
+        data = self.tb03_text.encode('ascii')
+        expected = [
+            (name, text.encode('ascii'))
+            for name, text in convert_text(self.tb03_text)
+        ]
+
+        assert convert_bytes(data) == expected
+        assert convert_bytes(io.BytesIO(data)) == expected
+
+
+class TestConvertStream(object):
+    """Test for convert_stream()
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv.convert_stream
+
+    def test_records(self, target):
+        import io
+
+        infile = io.StringIO(
+            'TRIPLET(0);\n'
+            'LAST_STEP(20);\n'
+            '%%\n'
+            '\n'
+            'END_STEP\t= 3\n'
+            'TRIPLET\t= 1\n'
+            '%%\n'
+        )
+        outfile = io.StringIO()
+
+        assert target(infile, outfile) == 3
+
+        records = outfile.getvalue().split('%%\n')
+        assert len(records) == 3
+        assert records[0].startswith('END_STEP\t= 15\n')
+        assert records[1].startswith('END_STEP\t= 4\n')
+        assert records[2].startswith('TRIPLET(1);\nLAST_STEP(3);\n')
+
+    def test_round_trip(self, target):
+        import io
+
+        text = 'TRIPLET(0);\nLAST_STEP(7);\nSTEP1(51,1,1,1);\n'
+        first = io.StringIO()
+        target(io.StringIO(text), first)
+        second = io.StringIO()
+        target(io.StringIO(first.getvalue()), second)
+
+        assert second.getvalue().splitlines()[:4] == [
+            'TRIPLET(0);',
+            'LAST_STEP(7);',
+            'GATE_WIDTH(67);',
+            'STEP1(51,1,1,1);',
+        ]
+
+    def test_invalid(self, target):
+        import io
+
+        with pytest.raises(ValueError):
+            target(io.StringIO('hoge\n'), io.StringIO())
+
+
+class TestConvertBank(object):
+    """Test for convert_bank()
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv.convert_bank
+
+    @pytest.fixture
+    def patterns(self):
+        from tbconv import Machine, Pattern
+
+        steps = bytes(range(40, 72)) + bytes([1, 0] * 48)
+        return [
+            Pattern(Machine.TB3, 7, 0, steps),
+            Pattern(Machine.TB3, 31, 1, steps),
+            Pattern(Machine.TB03, 15, 0, steps),
+            Pattern(Machine.TB3, 20, 0, bytes([24] * 32 + [3] * 96)),
+            Pattern(Machine.TB3, 99, 0, steps),
+            Pattern(Machine.TB03, 15, 5, steps),
+            Pattern(Machine.TB03, 31, 1, bytes(range(200, 232)) + steps[32:]),
+        ]
+
+    def test_numpy(self, target, patterns):
+        pytest.importorskip('numpy')
+
+        assert target(patterns) == [p.convert() for p in patterns]
+
+    def test_only_unsupported(self, target, patterns):
+        pytest.importorskip('numpy')
+
+        assert target(patterns[3:5]) == [p.convert() for p in patterns[3:5]]
+        assert target([]) == []
+
+    def test_without_numpy(self, target, patterns):
+        with mock.patch('tbconv.numpy', None):
+            assert target(patterns) == [p.convert() for p in patterns]
+
+    def test_stream(self):
+        import io
+        from tbconv import convert_stream
+
+        text = 'TRIPLET(0);\nLAST_STEP(20);\n%%\nEND_STEP\t= 3\n%%\n' * 3
+        outfile1 = io.StringIO()
+        outfile2 = io.StringIO()
+
+        assert convert_stream(io.StringIO(text), outfile1) == 9
+        assert convert_stream(io.StringIO(text), outfile2, bank_size=4) == 9
+        assert outfile1.getvalue() == outfile2.getvalue()
+
+        outfile3 = io.StringIO()
+        assert convert_stream(io.StringIO(text), outfile3, bank_size=0) == 9
+        assert outfile1.getvalue() == outfile3.getvalue()
+
+    def test_cli_bank_size(self, capsys):
+        from tbconv import cli
+
+        with pytest.raises(SystemExit) as e:
+            cli(['-', '-', '--bank-size', '0'])
+        assert e.value.code == 2
+        assert 'must be at least 1' in capsys.readouterr().err
+
+
+class TestConversionCache(object):
+    """Test for ConversionCache
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv.ConversionCache
+
+    def text(self, length):
+        return 'TRIPLET(0);\nLAST_STEP({});\n'.format(length)
+
+    def test_memory(self, target):
+        from tbconv import Pattern
+
+        cache = target(maxsize=2)
+        expected = Pattern.from_text(self.text(20)).convert()
+
+        assert cache.convert(self.text(20)) == expected
+        assert cache.convert(self.text(20)) == expected
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        cache.convert(self.text(1))
+        cache.convert(self.text(2))
+        cache.convert(self.text(20))
+        assert (cache.hits, cache.misses) == (1, 4)
+        assert len(cache.memory) == 2
+
+    def test_directory(self, tmp_path, target):
+        from tbconv import Pattern
+
+        target(directory=str(tmp_path)).convert(self.text(20))
+
+        cache = target(directory=str(tmp_path))
+        texts = cache.convert(self.text(20))
+        assert texts == Pattern.from_text(self.text(20)).convert()
+        assert (cache.hits, cache.misses) == (1, 0)
+
+    def test_eviction(self, tmp_path, target):
+        import os
+
+        cache = target(directory=str(tmp_path), max_bytes=1000)
+        for length in range(4):
+            cache.convert(self.text(length))
+            os.utime(
+                str(tmp_path / cache.key(self.text(length))),
+                (length, length))
+
+        assert sorted(os.listdir(str(tmp_path))) == [
+            cache.key(self.text(3)),
+        ]
+
+    def test_convert_text(self, target):
+        from tbconv import convert_text
+
+        cache = target()
+        assert convert_text(self.text(20), 'a.prm', cache) == \
+            convert_text(self.text(20), 'a.prm')
+        assert cache.misses == 1
+
+
+class TestSync(object):
+    """Test for sync()
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv.sync
+
+    @pytest.fixture
+    def source(self, tmp_path):
+        source = tmp_path / 'src'
+        (source / 'sub').mkdir(parents=True)
+        (source / 'short.prm').write_text('TRIPLET(0);\nLAST_STEP(7);\n')
+        (source / 'sub' / 'long.prm').write_text(
+            'TRIPLET(0);\nLAST_STEP(20);\n')
+        return source
+
+    def names(self, destination):
+        return sorted(
+            str(p.relative_to(destination)) for p in destination.rglob('*')
+            if p.is_file() and not p.name.startswith('.'))
+
+    def test_sync(self, tmp_path, target, source):
+        destination = tmp_path / 'dst'
+
+        converted, unchanged, removed, failed = target(
+            str(source), str(destination))
+        assert (len(converted), unchanged, removed, failed) == (2, 0, 0, [])
+        assert self.names(destination) == [
+            'short.prm', 'sub/longa.prm', 'sub/longb.prm']
+
+        converted, unchanged, removed, failed = target(
+            str(source), str(destination))
+        assert (len(converted), unchanged, removed, failed) == (0, 2, 0, [])
+
+    def test_changed(self, tmp_path, target, source):
+        destination = tmp_path / 'dst'
+        target(str(source), str(destination))
+
+        (source / 'sub' / 'long.prm').write_text(
+            'TRIPLET(0);\nLAST_STEP(3);\n')
+        converted, unchanged, removed, failed = target(
+            str(source), str(destination))
+
+        assert converted == [str(source / 'sub' / 'long.prm')]
+        assert self.names(destination) == ['short.prm', 'sub/long.prm']
+
+    def test_missing_output(self, tmp_path, target, source):
+        destination = tmp_path / 'dst'
+        target(str(source), str(destination))
+
+        (destination / 'sub' / 'longb.prm').unlink()
+        converted, unchanged, removed, failed = target(
+            str(source), str(destination))
+
+        assert converted == [str(source / 'sub' / 'long.prm')]
+        assert (destination / 'sub' / 'longb.prm').exists()
+
+    def test_removed(self, tmp_path, target, source):
+        destination = tmp_path / 'dst'
+        target(str(source), str(destination))
+
+        (source / 'sub' / 'long.prm').unlink()
+        converted, unchanged, removed, failed = target(
+            str(source), str(destination))
+
+        assert (len(converted), unchanged, removed) == (0, 1, 1)
+        assert self.names(destination) == ['short.prm']
+
+
+class TestArchive(object):
+    """Test for iter_archive() and convert_archive()
+    """
+    @pytest.fixture
+    def archive(self, tmp_path):
+        archive = tmp_path / 'archive.txt'
+        archive.write_text(
+            'TRIPLET(0);\nLAST_STEP(20);\nSTEP1(51,1,1,1);\n'
+            'END_STEP\t= 3\nTRIPLET\t= 1\n'
+            '%%\n'
+            'TRIPLET(1);\nLAST_STEP(7);\n'
+        )
+        return str(archive)
+
+    def test_iter_archive(self, archive):
+        from tbconv import iter_archive
+
+        chunks = [bytes(chunk) for chunk in iter_archive(archive)]
+
+        assert chunks == [
+            b'TRIPLET(0);\nLAST_STEP(20);\nSTEP1(51,1,1,1);\n',
+            b'END_STEP\t= 3\nTRIPLET\t= 1\n%%\n',
+            b'TRIPLET(1);\nLAST_STEP(7);\n',
+        ]
+
+    def test_empty(self, tmp_path):
+        from tbconv import iter_archive
+
+        archive = tmp_path / 'empty.txt'
+        archive.write_text('')
+
+        with pytest.raises(ValueError):
+            list(iter_archive(str(archive)))
+
+    @pytest.mark.parametrize('text', [
+        'hoge\n',
+        'hoge\nTRIPLET(0);\nLAST_STEP(7);\n',
+        # the first line of the second pattern is damaged
+        'TRIPLET(0);\nLAST_STEP(7);\nTRIPLEX(0);\nLAST_STEP(3);\n',
+        'END_STEP\t= 3\nTRIPLET\t= 1\nEND_STEX\t= 3\nTRIPLET\t= 0\n',
+    ])
+    def test_invalid(self, tmp_path, text):
+        from tbconv import iter_archive
+
+        archive = tmp_path / 'invalid.txt'
+        archive.write_text(text)
+
+        with pytest.raises(ValueError):
+            list(iter_archive(str(archive)))
+
+    def test_main_invalid(self, tmp_path, capsys):
+        from tbconv import cli
+
+        archive = tmp_path / 'BAD.PRM'
+        archive.write_text('hoge\n')
+
+        assert cli([str(archive), '-']) == 1
+        captured = capsys.readouterr()
+        assert captured.out == ''
+        assert captured.err == 'tbconv: Invalid file type.\n'
+
+    def test_convert_archive(self, archive):
+        import io
+        from tbconv import convert_archive
+
+        outfile = io.StringIO()
+        assert convert_archive(archive, outfile) == 4
+
+        records = outfile.getvalue().split('%%\n')
+        assert records[0].startswith('END_STEP\t= 15\n')
+        assert records[1].startswith('END_STEP\t= 4\n')
+        assert records[2].startswith('TRIPLET(1);\nLAST_STEP(3);\n')
+        assert records[3].startswith('END_STEP\t= 7\nTRIPLET\t= 1\n')
+
+
+class TestServe(object):
+    """Test for start_server()
+    """
+    def request(self, data, executor=None):
+        import asyncio
+        import concurrent.futures
+        from tbconv import start_server
+
+        async def scenario(executor):
+            server = await start_server(executor, port=0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', port)
+                writer.write(data)
+                response = await reader.read()
+                writer.close()
+            return response
+
+        if executor is not None:
+            return asyncio.run(scenario(executor))
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            return asyncio.run(scenario(executor))
+
+    def post(self, body, target='/convert?name=out.prm', executor=None):
+        return self.request((
+            'POST {} HTTP/1.1\r\n'
+            'Content-Length: {}\r\n'
+            'Connection: close\r\n'
+            '\r\n'
+        ).format(target, len(body)).encode('ascii') + body, executor)
+
+    def test_convert(self):
+        response = self.post(b'TRIPLET(0);\nLAST_STEP(20);\n')
+        head, _, body = response.partition(b'\r\n\r\n')
+
+        assert head.startswith(b'HTTP/1.1 200 OK\r\n')
+        assert b'\r\nX-Tbconv-Files: outa.prm, outb.prm' in head
+        records = body.split(b'%%\n')
+        assert len(records) == 2
+        assert records[0].startswith(b'END_STEP\t= 15\n')
+        assert records[1].startswith(b'END_STEP\t= 4\n')
+
+    def test_invalid(self):
+        response = self.post(b'hoge\n')
+
+        assert response.startswith(b'HTTP/1.1 400 Bad Request\r\n')
+        assert response.endswith(b'\r\n\r\nInvalid file type.\n')
+
+    def test_not_found(self):
+        response = self.post(b'', target='/hoge')
+
+        assert response.startswith(b'HTTP/1.1 404 Not Found\r\n')
+
+    def test_invalid_step(self):
+        response = self.post(b'TRIPLET(0);\nLAST_STEP(1);\nSTEP33(1,0,0,0);\n')
+
+        assert response.startswith(b'HTTP/1.1 400 Bad Request\r\n')
+        assert response.endswith(b'\r\n\r\nInvalid step 33.\n')
+
+    @pytest.mark.parametrize('name', [
+        'x%0D%0ASet-Cookie:%20evil=1',
+        '%E2%82%AC.prm',
+        '..%2Fout.prm',
+    ])
+    def test_invalid_name(self, name):
+        response = self.post(
+            b'TRIPLET(0);\n', target='/convert?name={}'.format(name))
+        head, _, body = response.partition(b'\r\n\r\n')
+
+        assert head.startswith(b'HTTP/1.1 400 Bad Request\r\n')
+        assert b'Set-Cookie' not in head
+        assert body == b'Invalid name.\n'
+
+    @pytest.mark.parametrize('error, status', [
+        (KeyError('x'), b'500 Internal Server Error'),
+        (None, b'503 Service Unavailable'),
+    ])
+    def test_failure(self, error, status):
+        import concurrent.futures
+
+        future = concurrent.futures.Future()
+        future.set_exception(
+            error or concurrent.futures.BrokenExecutor())
+        executor = mock.Mock()
+        executor.submit.return_value = future
+
+        response = self.post(b'TRIPLET(0);\n', executor=executor)
+        assert response.startswith(b'HTTP/1.1 ' + status + b'\r\n')
+
+    def test_renewing_pool(self):
+        import concurrent.futures
+        import os
+        from tbconv import RenewingPool
+
+        with RenewingPool(1) as pool:
+            with pytest.raises(concurrent.futures.BrokenExecutor):
+                pool.submit(os._exit, 1).result(timeout=10)
+            assert pool.submit(abs, -1).result(timeout=10) == 1
+
+    @pytest.mark.parametrize('length, status', [
+        (-1, b'400 Bad Request'),
+        (1024 * 1024 + 1, b'413 Payload Too Large'),
+    ])
+    def test_content_length(self, length, status):
+        response = self.request((
+            'POST /convert HTTP/1.1\r\n'
+            'Content-Length: {}\r\n'
+            '\r\n'
+        ).format(length).encode('ascii'))
+
+        assert response.startswith(b'HTTP/1.1 ' + status + b'\r\n')
+
+
+class TestFastStart(object):
+    """Test for start-up cost of the CLI
+    """
+    # time to import modules tbconv depends on, in microseconds
+    IMPORT_BUDGET = 30000
+
+    def run(self, *args):
+        import os.path
+        import subprocess
+        import sys
+
+        return subprocess.run(
+            [sys.executable] + list(args),
+            cwd=os.path.join(os.path.dirname(__file__), '..'),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+
+    def test_deferred_imports(self):
+        result = self.run('-c', (
+            'import sys, tbconv; '
+            'print(" ".join(sorted(sys.modules)))'
+        ))
+        modules = set(result.stdout.split())
+
+        for module in ('argparse', 'asyncio', 'concurrent.futures', 'glob',
+                       'hashlib', 'json', 'mmap', 'numpy', 're',
+                       'select', 'sqlite3', 'tarfile', 'urllib.parse',
+                       'zipfile'):
+            assert module not in modules
+
+    def test_import_time(self):
+        result = self.run('-X', 'importtime', '-c', 'import tbconv')
+
+        line = [
+            line for line in result.stderr.splitlines()
+            if line.endswith('| tbconv')
+        ][0]
+        self_time, cumulative, _ = line.split(':', 1)[1].split('|')
+        assert int(cumulative) - int(self_time) < self.IMPORT_BUDGET
+
+    def test_fast_args(self):
+        from tbconv import fast_args
+
+        assert fast_args(['in.prm', 'out.prm']) == \
+            ('in.prm', 'out.prm', False)
+        assert fast_args(['-p', 'in.prm', 'out.prm']) == \
+            ('in.prm', 'out.prm', True)
+        assert fast_args(['in.prm', '-']) is None
+        assert fast_args(['sync', 'out']) is None
+        assert fast_args(['in.prm', 'out.prm', '--cache-dir', 'c']) is None
+
+
+class TestStepLines(ParamsMixin):
+    """Test for tb03_lines() and tb3_lines()
+    """
+    def test_tb03_lines(self):
+        from tbconv import tb03_lines
+
+        self.accent[1] = 3
+        lines = list(tb03_lines(
+            20, 1, self.note, self.state, self.slide, self.accent))
+
+        assert lines[:5] == [
+            'END_STEP\t= 15\nTRIPLET\t= 1\n',
+            'STEP 1', '\t= STATE=0 NOTE=24 ACCENT=0 SLIDE=0\n',
+            'STEP 2', '\t= STATE=0 NOTE=24 ACCENT=3 SLIDE=0\n',
+        ]
+        assert len(lines) == 33
+
+        lines = list(tb03_lines(
+            20, 1, self.note, self.state, self.slide, self.accent, chunk=1))
+        assert lines[:3] == [
+            'END_STEP\t= 4\nTRIPLET\t= 1\n',
+            'STEP 1', '\t= STATE=0 NOTE=24 ACCENT=0 SLIDE=0\n',
+        ]
+
+    def test_tb3_lines(self):
+        from tbconv import step_tables, tb3_lines
+
+        self.note[31] = 300
+        lines = list(tb3_lines(
+            7, 0, self.note, self.state, self.slide, self.accent))
+
+        assert lines[0] == 'TRIPLET(0);\nLAST_STEP(7);\nGATE_WIDTH(67);\n'
+        assert lines[1:3] == ['STEP1', '(24,0,0,0);\n']
+        assert lines[-3:] == ['STEP32', '(300,0,0,0);\n', 'BANK(0);\n'
+                              'PATCH(-1);\n']
+        assert (300, 0, 0, 0) not in step_tables()[3]
+
+    def test_convert_lines(self):
+        from tbconv import Machine, Pattern
+
+        for machine in (Machine.TB3, Machine.TB03):
+            for length in (7, 20):
+                pattern = Pattern(machine, length, 1, bytes(range(128)))
+                assert [
+                    ''.join(lines) for lines in pattern.convert_lines()
+                ] == pattern.convert()
+
+
+class TestPatternStore(object):
+    """Test for PatternStore
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv.PatternStore
+
+    @pytest.fixture
+    def patterns(self):
+        from tbconv import Machine, Pattern
+
+        return [
+            Pattern(Machine.TB3, 20, 1, bytes(range(32)) + bytes(
+                [0, 1, 2, 3] * 24)),
+            Pattern(Machine.TB03, 7, 0),
+            Pattern(Machine.TB3, -1, 0),
+        ]
+
+    def test_pack(self, patterns):
+        from tbconv import PatternStore, pack_pattern, unpack_pattern
+
+        for pattern in patterns:
+            record = pack_pattern(pattern)
+            assert len(record) == PatternStore.RECORD.size == 68
+            assert unpack_pattern(record) == pattern
+
+    def test_pack_overflow(self):
+        from tbconv import Machine, Pattern, pack_pattern
+
+        pattern = Pattern(Machine.TB3, 16, 0, bytes([24] * 32 + [4] * 96))
+        with pytest.raises(ValueError):
+            pack_pattern(pattern)
+
+    def test_random_access(self, tmp_path, target, patterns):
+        path = str(tmp_path / 'store.tbps')
+        with target(path, 'w') as store:
+            for pattern in patterns[:2]:
+                store.append(pattern)
+        with target(path, 'a') as store:
+            assert store.append(patterns[2]) == 2
+
+        with target(path) as store:
+            assert len(store) == 3
+            assert store[2] == patterns[2]
+            assert store[0] == patterns[0]
+            assert store[-2] == patterns[1]
+            assert list(store) == patterns
+            with pytest.raises(IndexError):
+                store[3]
+
+        assert (tmp_path / 'store.tbps').stat().st_size == \
+            target.HEADER.size + 3 * target.RECORD.size
+
+    def test_not_store(self, tmp_path, target):
+        path = tmp_path / 'store.tbps'
+        path.write_bytes(b'TRIPLET(0);\n')
+
+        with pytest.raises(ValueError):
+            target(str(path))
+
+    def test_main(self, tmp_path, capsys):
+        import os.path
+        from tbconv import pack_main, unpack_main
+
+        samples = os.path.join(os.path.dirname(__file__), '..', 'samples')
+        bad = tmp_path / 'BAD.PRM'
+        bad.write_text('hoge\n')
+        store = str(tmp_path / 'store.tbps')
+
+        assert pack_main([store, samples, str(bad)]) == 1
+        out = capsys.readouterr().out
+        assert 'FAILED  {}: Invalid file type.'.format(bad) in out
+        assert out.endswith('2 patterns in {}, 1 failed.\n'.format(store))
+
+        assert unpack_main([
+            store, str(tmp_path / 'out'), '--index', '1', '--index', '2',
+        ]) == 1
+        out = capsys.readouterr().out
+        assert 'PTN00001.PRM' in out
+        assert 'FAILED  2: No such pattern' in out
+
+
+class TestPatternLibrary(object):
+    """Test for PatternLibrary
+    """
+    @pytest.fixture
+    def source(self, tmp_path):
+        import os.path
+        import shutil
+
+        samples = os.path.join(os.path.dirname(__file__), '..', 'samples')
+        source = tmp_path / 'source'
+        source.mkdir()
+        for name in ('TB3_PTN1.PRM', 'TB03_PTN1_01.PRM'):
+            shutil.copy(os.path.join(samples, name), str(source / name))
+        shutil.copy(
+            os.path.join(samples, 'TB3_PTN1.PRM'), str(source / 'COPY.PRM'))
+        return source
+
+    @pytest.fixture
+    def target(self, tmp_path):
+        import tbconv
+        library = tbconv.PatternLibrary(str(tmp_path / 'library.db'))
+        yield library
+        library.close()
+
+    def test_update(self, source, target):
+        import os.path
+
+        indexed, unchanged, removed, failed = target.update(
+            [str(source)], jobs=1)
+        assert (indexed, unchanged, removed, failed) == (3, 0, 0, [])
+
+        assert target.update([str(source)], jobs=1) == (0, 3, 0, [])
+
+        (source / 'COPY.PRM').write_text('END_STEP\t= 3\n')
+        (source / 'TB03_PTN1_01.PRM').unlink()
+        (source / 'BAD.PRM').write_text('invalid\n')
+        indexed, unchanged, removed, failed = target.update([str(source)])
+        assert (indexed, unchanged, removed) == (1, 1, 1)
+        assert [os.path.basename(path) for path, _ in failed] == ['BAD.PRM']
+
+    def test_search(self, source, target):
+        import os.path
+
+        target.update([str(source)], jobs=1)
+
+        found = target.search(step=1, note=51, accent=1)
+        assert [os.path.basename(path) for path, _ in found] == \
+            ['COPY.PRM', 'TB3_PTN1.PRM']
+        assert target.search(step=17) == []
+        assert target.search(note=127) == []
+
+    def test_duplicates(self, source, target):
+        import os.path
+
+        target.update([str(source)], jobs=1)
+
+        groups = target.duplicates()
+        assert [
+            sorted(os.path.basename(path) for path, _ in group)
+            for group in groups
+        ] == [['COPY.PRM', 'TB3_PTN1.PRM']]
+
+    def test_similar(self, source, target):
+        import os.path
+
+        text = (source / 'TB3_PTN1.PRM').read_text()
+        (source / 'EDIT.PRM').write_text(
+            text.replace('STEP2(48,', 'STEP2(50,'))
+        target.update([str(source)], jobs=1)
+
+        similar = target.similar(str(source / 'TB3_PTN1.PRM'))
+        assert [
+            (os.path.basename(path), position, diff)
+            for path, position, diff in similar
+        ] == [('COPY.PRM', 0, 0), ('EDIT.PRM', 0, 1)]
+
+
+class TestDedupe(object):
+    """Test for dedupe()
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv.dedupe
+
+    @pytest.fixture
+    def source(self, tmp_path):
+        import os.path
+
+        samples = os.path.join(os.path.dirname(__file__), '..', 'samples')
+        with open(os.path.join(samples, 'TB3_PTN1.PRM'), 'rt') as prm:
+            text = prm.read()
+
+        source = tmp_path / 'source'
+        source.mkdir()
+        (source / 'A.PRM').write_text(text)
+        (source / 'B.PRM').write_text(text.replace('GATE_WIDTH(70)', ''))
+        # differs only after LAST_STEP
+        (source / 'C.PRM').write_text(
+            text.replace('STEP20(50,', 'STEP20(36,'))
+        (source / 'D.PRM').write_text(text.replace('STEP2(48,', 'STEP2(50,'))
+        return source
+
+    def test_dedupe(self, tmp_path, target, source):
+        import os
+
+        input_files = sorted(str(path) for path in source.iterdir())
+        output_dir = str(tmp_path / 'output')
+        results = target(input_files, output_dir)
+
+        assert [error for _, _, error, _ in results] == [None] * 4
+        assert [original for _, _, _, original in results] == \
+            [None, input_files[0], input_files[0], None]
+        a, b, c, d = [
+            os.stat(os.path.join(output_dir, name))
+            for name in ('A.PRM', 'B.PRM', 'C.PRM', 'D.PRM')
+        ]
+        assert a.st_ino == b.st_ino == c.st_ino != d.st_ino
+        assert a.st_nlink == 3
+
+    def test_same_names(self, tmp_path, target, source):
+        import os
+
+        for name in ('a', 'b'):
+            (tmp_path / name).mkdir()
+            (tmp_path / name / 'P.PRM').write_text(
+                (source / 'A.PRM').read_text())
+        output_dir = tmp_path / 'output'
+
+        results = target(
+            [str(tmp_path / 'a' / 'P.PRM'), str(tmp_path / 'b' / 'P.PRM')],
+            str(output_dir))
+
+        assert [outputs for _, outputs, _, _ in results] == [
+            [str(output_dir / 'a' / 'P.PRM')],
+            [str(output_dir / 'b' / 'P.PRM')],
+        ]
+        assert os.stat(str(output_dir / 'a' / 'P.PRM')).st_nlink == 2
+
+    def test_collision(self, tmp_path, target, source):
+        text = (source / 'A.PRM').read_text()
+        # A.PRM is split into Aa.PRM and Ab.PRM
+        (source / 'A.PRM').write_text(
+            text.replace('LAST_STEP(15)', 'LAST_STEP(20)'))
+        (source / 'Ab.PRM').write_text(text)
+        output_dir = tmp_path / 'output'
+        input_files = [str(source / 'A.PRM'), str(source / 'Ab.PRM')]
+
+        results = target(input_files, str(output_dir))
+
+        assert [len(outputs) for _, outputs, _, _ in results] == [2, 0]
+        assert str(results[1][2]) == '{} is already written from {}.'.format(
+            output_dir / 'Ab.PRM', input_files[0])
+        target(input_files[1:], str(tmp_path / 'alone'))
+        assert (output_dir / 'Ab.PRM').read_text() != \
+            (tmp_path / 'alone' / 'Ab.PRM').read_text()
+
+
+class TestStats(object):
+    """Test for Stats
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv.Stats
+
+    @property
+    def tb3_file(self):
+        import os.path
+        return os.path.join(
+            os.path.dirname(__file__), '..', 'samples', 'TB3_PTN1.PRM')
+
+    def test_install(self, tmp_path, target):
+        import tbconv
+
+        read_param = tbconv.read_param
+        with target() as stats:
+            assert tbconv.STATS is stats
+            assert tbconv.read_param is not read_param
+            tbconv.convert_file(self.tb3_file, str(tmp_path / 'OUT.PRM'))
+        assert tbconv.STATS is None
+        assert tbconv.read_param is read_param
+
+        counters = stats.as_dict()['counters']
+        assert counters['files_read'] == counters['files_written'] == 1
+        assert counters['files_split'] == 0
+        assert counters['steps_written'] == 16
+        assert counters['lines_parsed'] == 37
+        assert counters['bytes_written'] == \
+            (tmp_path / 'OUT.PRM').stat().st_size
+        assert stats.calls['read_params'] == 1
+
+    def test_merge(self, target):
+        stats = target()
+        stats.merge({
+            'timers': {'read_param': {'calls': 2, 'seconds': 0.5}},
+            'counters': {'lines_parsed': 2},
+        })
+        stats.merge(stats.as_dict())
+        assert stats.calls['read_param'] == 4
+        assert stats.seconds['read_param'] == 1.0
+        assert stats.counters['lines_parsed'] == 4
+
+    def test_cli(self, tmp_path, capsys):
+        import json
+        from tbconv import cli
+
+        stats_json = tmp_path / 'stats.json'
+        profile = tmp_path / 'profile.prof'
+        cli([
+            self.tb3_file, str(tmp_path / 'OUT.PRM'), '--stats',
+            '--stats-json', str(stats_json), '--profile', str(profile),
+        ])
+
+        assert 'lines_parsed' in capsys.readouterr().out
+        stats = json.loads(stats_json.read_text())
+        assert stats['timers']['get_machine_type']['calls'] >= 1
+        assert profile.stat().st_size > 0
+
+
+class TestValidate(object):
+    """Test for validate_text() and validate()
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv.validate_text
+
+    @property
+    def samples(self):
+        import os.path
+        return os.path.join(os.path.dirname(__file__), '..', 'samples')
+
+    def test_samples(self, target):
+        import os
+
+        for name in os.listdir(self.samples):
+            with open(os.path.join(self.samples, name), 'rt') as prm:
+                assert target(prm.read()) == []
+
+    def test_tb3(self, target):
+        problems = target(
+            'TRIPLET(2);\n'
+            'LAST_STEP(32);\n'
+            'STEP1(51,1,1,1);\n'
+            'STEP1(128,0,2,0);\n'
+            'STEP33(24,0,0,0);\n'
+            'STEP2(24,0,0);\n'
+        )
+        assert problems == [
+            (1, 'TRIPLET must be 0 or 1: 2'),
+            (2, 'LAST_STEP out of range 0..31: 32'),
+            (4, 'Duplicate step: 1'),
+            (4, 'Note out of range 0..127: 128'),
+            (4, 'State must be 0 or 1: 2'),
+            (5, 'Step out of range 1..32: 33'),
+            (6, "Malformed line: 'STEP2(24,0,0);'"),
+        ]
+
+    def test_tb03(self, target):
+        problems = target(
+            'END_STEP\t= 16\n'
+            'STEP 17\t= STATE=1 NOTE=50 ACCENT=0 SLIDE=-1\n'
+        )
+        assert problems == [
+            (1, 'END_STEP out of range 0..15: 16'),
+            (2, 'Step out of range 1..16: 17'),
+            (2, 'Slide must be 0 or 1: -1'),
+            (None, 'Missing TRIPLET'),
+        ]
+
+    @pytest.mark.parametrize('line, valid', [
+        ('STEP 1\t= STATE=1 NOTE=48 ACCENT=0 SLIDE=0', True),
+        ('STEP 1 =  STATE=1 NOTE=48 ACCENT=0\tSLIDE=0', True),
+        ('STEP 1=STATE=1 NOTE=48 ACCENT=0 SLIDE=0', False),
+        ('STEP 1\t= STATE= 1 NOTE=48 ACCENT=0 SLIDE=0', False),
+        ('STEP 1\t= STATE=1 NOTE =48 ACCENT=0 SLIDE=0', False),
+    ])
+    def test_tb03_grammar(self, target, line, valid):
+        from tbconv import convert_text
+
+        text = 'END_STEP\t= 0\nTRIPLET\t= 0\n{}\n'.format(line)
+        assert (target(text) == []) is valid
+        if valid:
+            convert_text(text, 'P.PRM')
+        else:
+            with pytest.raises(ValueError):
+                convert_text(text, 'P.PRM')
+
+    def test_unknown(self, target):
+        assert target('') == [(1, 'Unknown file type')]
+
+    def test_validate(self, tmp_path):
+        import os.path
+        from tbconv import validate
+
+        bad = tmp_path / 'BAD.PRM'
+        bad.write_text('LAST_STEP(15);\n')
+        input_files = [
+            str(bad), os.path.join(self.samples, 'TB3_PTN1.PRM'), str(bad)]
+
+        problems = list(validate(input_files, jobs=2))
+        assert problems == [(str(bad), 1, 'Unknown file type')] * 2
+        problems = list(validate(input_files, jobs=1, fail_fast=True))
+        assert problems == [(str(bad), 1, 'Unknown file type')]
+
+
+class TestNaming(object):
+    """Test for Naming
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv.Naming
+
+    def test_names(self, target):
+        naming = target()
+        assert naming.names('PTN1.PRM', 1) == ['PTN1.PRM']
+        assert naming.names('PTN1.PRM', 2) == ['PTN1a.PRM', 'PTN1b.PRM']
+        assert naming.names('out.v2/PTN1', 2) == \
+            ['out.v2/PTN1a', 'out.v2/PTN1b']
+        assert naming.names('a.b.PRM', 2) == ['a.ba.PRM', 'a.bb.PRM']
+
+        naming = target('{root}_{number}{ext}')
+        assert naming.names('PTN1.PRM', 3) == \
+            ['PTN1_1.PRM', 'PTN1_2.PRM', 'PTN1_3.PRM']
+
+    def test_parse(self, target):
+        naming = target()
+        assert naming.parse('PTN1a.PRM') == ('PTN1.PRM', 0)
+        assert naming.parse('PTN1B.PRM') == ('PTN1.PRM', 1)
+        assert naming.parse('PTN1.PRM') is None
+
+        naming = target('{root}_{number}{ext}')
+        assert naming.parse('PTN1_2.PRM') == ('PTN1.PRM', 1)
+        assert naming.parse('PTN1a.PRM') is None
+        for name in naming.names('x.y.PRM', 2):
+            assert naming.parse(name)[0] == 'x.y.PRM'
+
+
+class TestMerge(object):
+    """Test for Pattern.split(), Pattern.merge() and merge()
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv.merge
+
+    @property
+    def tb3_file(self):
+        import os.path
+        return os.path.join(
+            os.path.dirname(__file__), '..', 'samples', 'TB3_PTN1.PRM')
+
+    @pytest.fixture
+    def pattern(self):
+        from tbconv import Pattern
+
+        with open(self.tb3_file, 'rt') as prm:
+            text = prm.read()
+        return Pattern.from_text(
+            text.replace('LAST_STEP(15)', 'LAST_STEP(27)'))
+
+    def test_split(self, pattern):
+        from tbconv import Pattern
+
+        chunks = pattern.split()
+        assert [chunk.length for chunk in chunks] == [15, 11]
+        assert chunks[1].note[:16] == pattern.note[16:]
+        assert Pattern.merge(chunks) == pattern
+        assert [chunk.to_tb03()[0] for chunk in chunks] == pattern.to_tb03()
+
+        with pytest.raises(ValueError):
+            Pattern.merge(chunks * 2)
+
+    def test_merge(self, tmp_path, target, pattern):
+        from tbconv import Machine, Pattern, convert_file
+
+        split = tmp_path / 'split.d'
+        split.mkdir()
+        (split / 'LONG.PRM').write_text(pattern.to_tb3())
+        convert_file(str(split / 'LONG.PRM'), str(split / 'LONG.PRM'))
+        # not split from one pattern, as SHORTa.PRM has 8 steps
+        short = pattern.split()[1]
+        short.length = 7
+        for name in ('SHORTa.PRM', 'SHORTb.PRM'):
+            (split / name).write_text(short.to_tb03()[0])
+
+        input_files = sorted(
+            str(path) for path in split.iterdir() if path.name != 'LONG.PRM')
+        results = target(input_files, str(tmp_path / 'merged'))
+
+        assert [
+            ([path.split('/')[-1] for path in group], error)
+            for group, _, error in results
+        ] == [
+            (['LONGa.PRM', 'LONGb.PRM'], None),
+            (['SHORTa.PRM'], None),
+            (['SHORTb.PRM'], None),
+        ]
+        merged = Pattern.from_text(
+            (tmp_path / 'merged' / 'LONG.PRM').read_text())
+        assert merged.machine == Machine.TB3
+        assert merged == pattern
+
+    def test_collision(self, tmp_path, target, pattern):
+        source = tmp_path / 'source'
+        source.mkdir()
+        chunks = pattern.to_tb03()
+        (source / 'X1.PRM').write_text(chunks[0])
+        for name, text in zip(['X1a.PRM', 'X1b.PRM', 'X1B.PRM'], chunks * 2):
+            (source / name).write_text(text)
+
+        input_files = sorted(str(path) for path in source.iterdir())
+        results = target(input_files, str(tmp_path / 'merged'))
+
+        # nothing is merged over X1.PRM, nor is X1b.PRM dropped for X1B.PRM
+        assert sorted(
+            path.split('/')[-1] for group, _, error in results
+            for path in group if error is None
+        ) == ['X1.PRM', 'X1B.PRM', 'X1a.PRM', 'X1b.PRM']
+        assert len(results) == 4
+        assert sorted(path.name for path in (tmp_path / 'merged').iterdir()) \
+            == ['X1.PRM', 'X1B.PRM', 'X1a.PRM', 'X1b.PRM']
+
+
+class TestBundle(object):
+    """Test for convert_bundle()
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv.convert_bundle
+
+    @pytest.fixture
+    def members(self):
+        import os.path
+
+        samples = os.path.join(os.path.dirname(__file__), '..', 'samples')
+        with open(os.path.join(samples, 'TB3_PTN1.PRM'), 'rt') as prm:
+            text = prm.read()
+        return {
+            'dev/SHORT.PRM': text,
+            'dev/LONG.PRM': text.replace('LAST_STEP(15)', 'LAST_STEP(20)'),
+            'dev/BAD.PRM': 'invalid\n',
+            'dev/README.TXT': 'not converted\n',
+        }
+
+    @pytest.fixture
+    def bundle(self, tmp_path, members):
+        import zipfile
+
+        path = str(tmp_path / 'backup.zip')
+        with zipfile.ZipFile(path, 'w') as bundle:
+            for name, text in members.items():
+                bundle.writestr(name, text)
+        return path
+
+    def read_tar(self, path):
+        import tarfile
+
+        with tarfile.open(path) as bundle:
+            return dict(
+                (member.name, bundle.extractfile(member).read().decode())
+                for member in bundle)
+
+    def test_zip_to_tar(self, tmp_path, target, members, bundle):
+        from tbconv import convert_text
+
+        output_file = str(tmp_path / 'converted.tar.gz')
+        results = target(bundle, output_file)
+
+        assert [(member, outputs) for member, outputs, _ in results] == [
+            ('dev/SHORT.PRM', ['dev/SHORT.PRM']),
+            ('dev/LONG.PRM', ['dev/LONGa.PRM', 'dev/LONGb.PRM']),
+            ('dev/BAD.PRM', []),
+        ]
+        assert isinstance(results[2][2], ValueError)
+
+        converted = self.read_tar(output_file)
+        expected = dict(convert_text(members['dev/LONG.PRM'], 'dev/LONG.PRM'))
+        expected.update(
+            convert_text(members['dev/SHORT.PRM'], 'dev/SHORT.PRM'))
+        expected['dev/README.TXT'] = members['dev/README.TXT']
+        assert converted == expected
+
+    def test_round_trip(self, tmp_path, target, bundle):
+        import zipfile
+
+        target(bundle, str(tmp_path / 'converted.tar'))
+        target(str(tmp_path / 'converted.tar'), str(tmp_path / 'back.zip'))
+
+        with zipfile.ZipFile(str(tmp_path / 'back.zip')) as back:
+            assert sorted(back.namelist()) == [
+                'dev/LONGa.PRM', 'dev/LONGb.PRM', 'dev/README.TXT',
+                'dev/SHORT.PRM',
+            ]
+
+    def test_tar_to_zip_epoch(self, tmp_path, target, members):
+        import io
+        import tarfile
+        import zipfile
+
+        path = str(tmp_path / 'backup.tar')
+        with tarfile.open(path, 'w') as bundle:
+            data = members['dev/SHORT.PRM'].encode()
+            info = tarfile.TarInfo('dev/SHORT.PRM')
+            info.size = len(data)
+            info.mtime = 0
+            bundle.addfile(info, io.BytesIO(data))
+
+        results = target(path, str(tmp_path / 'converted.zip'))
+
+        assert results == [('dev/SHORT.PRM', ['dev/SHORT.PRM'], None)]
+        with zipfile.ZipFile(str(tmp_path / 'converted.zip')) as converted:
+            assert converted.getinfo('dev/SHORT.PRM').date_time == \
+                (1980, 1, 1, 0, 0, 0)
+
+    def test_not_bundle(self, tmp_path, target, bundle):
+        with pytest.raises(ValueError):
+            target(bundle, str(tmp_path / 'converted.prm'))
+
+    def test_same_file(self, tmp_path, target, bundle):
+        with open(bundle, 'rb') as f:
+            data = f.read()
+
+        with pytest.raises(ValueError):
+            target(bundle, bundle)
+        with open(bundle, 'rb') as f:
+            assert f.read() == data
+
+    @pytest.mark.parametrize('name', ['broken.zip', 'broken.tar.gz'])
+    def test_broken(self, tmp_path, capsys, name):
+        from tbconv import bundle_main
+
+        input_file = tmp_path / name
+        input_file.write_bytes(b'PK\x03\x04 not a bundle' * 10)
+        output_file = tmp_path / 'converted.zip'
+
+        assert bundle_main(str(input_file), str(output_file)) == 1
+        assert 'Invalid bundle' in capsys.readouterr().out
+        assert sorted(path.name for path in tmp_path.iterdir()) == [name]
+
+
+class TestWatch(object):
+    """Test for watch()
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv.watch
+
+    @property
+    def text(self):
+        import os.path
+
+        samples = os.path.join(os.path.dirname(__file__), '..', 'samples')
+        with open(os.path.join(samples, 'TB3_PTN1.PRM'), 'rt') as prm:
+            return prm.read()
+
+    def run(self, target, source, destination, names, polling):
+        import threading
+
+        stop = threading.Event()
+        # in case files are never converted
+        timer = threading.Timer(10, stop.set)
+        timer.start()
+
+        def arrive():
+            for name in names:
+                with open(str(source / name), 'wt') as prm:
+                    prm.write(self.text[:100])
+                    prm.flush()
+                    stop.wait(0.02)
+                    prm.write(self.text[100:])
+
+        threading.Timer(0.2, arrive).start()
+        results = []
+        try:
+            for result in target(
+                    str(source), str(destination), jobs=1, debounce=0.2,
+                    polling=polling, stop=stop):
+                results.append(result)
+                if len(results) >= len(names) + 1:
+                    stop.set()
+        finally:
+            timer.cancel()
+        return results
+
+    @pytest.mark.parametrize('polling', [False, True])
+    def test_watch(self, tmp_path, target, polling):
+        import os.path
+
+        source = tmp_path / 'source'
+        source.mkdir()
+        destination = tmp_path / 'destination'
+        destination.mkdir()
+        # converted before
+        (source / 'OLD.PRM').write_text(self.text)
+        (destination / 'OLD.PRM').write_text('')
+        (source / 'EXISTING.PRM').write_text(self.text)
+
+        results = self.run(
+            target, source, destination, ['NEW1.PRM', 'NEW2.PRM'], polling)
+
+        assert sorted(
+            (os.path.basename(input_file), error)
+            for input_file, _, error in results
+        ) == [('EXISTING.PRM', None), ('NEW1.PRM', None), ('NEW2.PRM', None)]
+        assert (destination / 'OLD.PRM').read_text() == ''
+        assert (destination / 'NEW1.PRM').read_text() == \
+            (destination / 'EXISTING.PRM').read_text()
+
+    def test_failure(self, tmp_path, target):
+        import os.path
+
+        source = tmp_path / 'source'
+        source.mkdir()
+        destination = tmp_path / 'destination'
+        (source / 'BAD.PRM').write_text(
+            'TRIPLET(0);\nLAST_STEP(1);\nSTEP33(48,0,1,0);\n')
+
+        results = self.run(
+            target, source, destination, ['NEW1.PRM', 'NEW2.PRM'], False)
+
+        errors = dict(
+            (os.path.basename(input_file), error)
+            for input_file, _, error in results)
+        assert sorted(errors) == ['BAD.PRM', 'NEW1.PRM', 'NEW2.PRM']
+        assert isinstance(errors['BAD.PRM'], ValueError)
+        assert errors['NEW1.PRM'] is errors['NEW2.PRM'] is None
+
+    def test_unexpected_error(self, tmp_path):
+        from tbconv import _convert_files
+
+        pairs = [('A.PRM', 'OUT/A.PRM'), ('B.PRM', 'OUT/B.PRM')]
+        with mock.patch(
+                'tbconv.convert_file', side_effect=[KeyError('a'), ['B']]):
+            results = _convert_files(pairs)
+
+        assert isinstance(results[0][2], KeyError)
+        assert results[1] == ('B.PRM', ['B'], None)
+
+
+class TestJournal(object):
+    """Test for batch() with Journal
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv.Journal
+
+    @pytest.fixture
+    def input_files(self, tmp_path):
+        import os.path
+
+        samples = os.path.join(os.path.dirname(__file__), '..', 'samples')
+        with open(os.path.join(samples, 'TB3_PTN1.PRM'), 'rt') as prm:
+            text = prm.read()
+        source = tmp_path / 'source'
+        source.mkdir()
+        for index in range(5):
+            (source / 'P{}.PRM'.format(index)).write_text(text)
+        return sorted(str(path) for path in source.iterdir())
+
+    def test_resume(self, tmp_path, target, input_files):
+        import json
+        from tbconv import batch
+
+        path = str(tmp_path / 'journal')
+        output_dir = tmp_path / 'output'
+        with target(path) as journal:
+            results = batch(
+                input_files[:3], str(output_dir), jobs=1, journal=journal,
+                batch_size=2)
+        assert len(results) == 3
+        with open(path, 'rt') as f:
+            lines = f.readlines()
+        assert len(lines) == 3
+
+        # crashed while writing the last line, and an output was damaged
+        with open(path, 'wt') as f:
+            f.writelines(lines[:2] + [lines[2][:20]])
+        (output_dir / 'P1.PRM').write_text('damaged')
+
+        with target(path) as journal:
+            results = batch(
+                input_files, str(output_dir), jobs=1, journal=journal)
+        assert [input_file for input_file, _, _, _ in results] == \
+            input_files[1:]
+        with open(path, 'rt') as f:
+            lines = f.readlines()
+        assert [json.loads(line)[0] for line in lines] == \
+            input_files[:2] + input_files[1:]
+
+        with target(path) as journal:
+            assert batch(
+                input_files, str(output_dir), jobs=1, journal=journal) == []
+
+    def test_verify(self, tmp_path, target, input_files):
+        from tbconv import batch
+
+        path = str(tmp_path / 'journal')
+        output_dir = tmp_path / 'output'
+        with target(path) as journal:
+            batch(input_files[:1], str(output_dir), jobs=1, journal=journal)
+
+        output = output_dir / 'P0.PRM'
+        output.write_text(output.read_text().replace('NOTE=51', 'NOTE=52'))
+        with target(path) as journal:
+            assert journal.done(input_files[0])
+            assert not journal.done(input_files[0], verify=True)
+
+
+class TestWriteFile(object):
+    """Test for write_file()
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv.write_file
+
+    def test_unchanged(self, tmp_path, target):
+        output = tmp_path / 'OUT.PRM'
+        assert target(str(output), 'TRIPLET(0);\n') is True
+        stat = output.stat()
+
+        assert target(str(output), 'TRIPLET(0);\n') is False
+        assert output.stat().st_mtime_ns == stat.st_mtime_ns
+        assert output.stat().st_ino == stat.st_ino
+
+        assert target(str(output), 'TRIPLET(1);\n') is True
+        assert output.read_text() == 'TRIPLET(1);\n'
+        assert output.stat().st_ino != stat.st_ino
+        assert [p.name for p in tmp_path.iterdir()] == ['OUT.PRM']
+
+    def test_failed(self, tmp_path, target):
+        output = tmp_path / 'OUT.PRM'
+        output.write_text('TRIPLET(0);\n')
+
+        with mock.patch('tbconv.os.replace', side_effect=OSError):
+            with pytest.raises(OSError):
+                target(str(output), 'TRIPLET(1);\n')
+        assert output.read_text() == 'TRIPLET(0);\n'
+        assert [p.name for p in tmp_path.iterdir()] == ['OUT.PRM']
+
+    def test_fsync(self, tmp_path, capsys):
+        import os.path
+        import tbconv
+
+        output = tmp_path / 'OUT.PRM'
+        samples = os.path.join(os.path.dirname(__file__), '..', 'samples')
+        try:
+            with mock.patch('tbconv.os.fsync') as m_fsync:
+                tbconv.cli([
+                    os.path.join(samples, 'TB3_PTN1.PRM'),
+                    str(output), '--fsync'])
+        finally:
+            tbconv.FSYNC = False
+
+        # the output file and its directory
+        assert m_fsync.call_count == 2
+        assert output.exists()
+
+
+class TestDistribute(object):
+    """Test for distribute() and work()
+    """
+    @pytest.fixture
+    def target(self):
+        import tbconv
+        return tbconv.distribute
+
+    @pytest.fixture
+    def input_files(self, tmp_path):
+        import os.path
+
+        samples = os.path.join(os.path.dirname(__file__), '..', 'samples')
+        with open(os.path.join(samples, 'TB3_PTN1.PRM'), 'rt') as prm:
+            text = prm.read()
+        source = tmp_path / 'source'
+        source.mkdir()
+        for index in range(9):
+            (source / 'P{}.PRM'.format(index)).write_text(text)
+        (source / 'BAD.PRM').write_text('broken')
+        (source / 'RANGE.PRM').write_text(
+            'TRIPLET(0);\nLAST_STEP(1);\nSTEP33(48,0,1,0);\n')
+        return sorted(str(path) for path in source.iterdir())
+
+    def test_workers(self, tmp_path, target, input_files):
+        import os.path
+        import subprocess
+        import sys
+
+        queue_dir = str(tmp_path / 'queue')
+        output_dir = tmp_path / 'output'
+        script = os.path.join(os.path.dirname(__file__), '..', 'tbconv.py')
+        workers = [
+            subprocess.Popen(
+                [sys.executable, script, 'worker', queue_dir,
+                 '--poll', '0.05'],
+                stdout=subprocess.DEVNULL)
+            for _ in range(3)]
+        try:
+            results = target(
+                input_files, str(output_dir), queue_dir, unit_size=2,
+                poll=0.05)
+        finally:
+            for worker in workers:
+                assert worker.wait(timeout=10) == 0
+
+        assert [input_file for input_file, _, _, _ in results] == \
+            input_files
+        assert [error is None for _, _, error, _ in results] == \
+            [False] + [True] * 9 + [False]
+        assert len(list(output_dir.iterdir())) == 9
+        for name in ('todo', 'claimed', 'done'):
+            assert os.listdir(os.path.join(queue_dir, name)) == []
+
+        (tmp_path / 'queue' / 'todo' / 'left.json').write_text('')
+        with pytest.raises(ValueError):
+            target(input_files, str(output_dir), queue_dir)
+
+    def test_same_names(self, tmp_path, input_files):
+        from tbconv import create_queue, work
+
+        for name in ('a', 'b'):
+            (tmp_path / name).mkdir()
+            (tmp_path / name / 'P.PRM').write_text(
+                (tmp_path / 'source' / 'P0.PRM').read_text())
+        queue_dir = str(tmp_path / 'queue')
+        output_dir = tmp_path / 'output'
+        create_queue(
+            [str(tmp_path / 'a' / 'P.PRM'), str(tmp_path / 'b' / 'P.PRM')],
+            str(output_dir), queue_dir)
+
+        unit, results = next(work(queue_dir))
+
+        assert [outputs for _, outputs, _ in results] == [
+            [str(output_dir / 'a' / 'P.PRM')],
+            [str(output_dir / 'b' / 'P.PRM')],
+        ]
+
+    @pytest.mark.parametrize('retries', [0, 1])
+    def test_stale(self, tmp_path, target, input_files, retries):
+        import threading
+        import time
+        from tbconv import claim_unit, work, worker_id
+
+        queue_dir = str(tmp_path / 'queue')
+        results = []
+        stop = threading.Event()
+        coordinator = threading.Thread(target=lambda: results.extend(target(
+            input_files, str(tmp_path / 'output'), queue_dir,
+            unit_size=5, stale=0.2, retries=retries, poll=0.05,
+            stop=stop)))
+        coordinator.start()
+        # in case units are never done
+        timer = threading.Timer(10, stop.set)
+        timer.start()
+        try:
+            # a worker dies after claiming a unit
+            while claim_unit(queue_dir, 'dead-1') is None:
+                time.sleep(0.01)
+            units = list(work(queue_dir, poll=0.05, stop=stop))
+            coordinator.join()
+        finally:
+            timer.cancel()
+
+        assert not stop.is_set()
+        workers = set(worker for _, _, _, worker in results)
+        if retries:
+            assert len(units) == 3
+            assert workers == {worker_id()}
+        else:
+            assert len(units) == 2
+            assert workers == {worker_id(), None}
+            assert set(
+                error for _, _, error, worker in results if worker is None
+            ) == {'Claim went stale after 0 retries.'}
+
+    def test_idle(self, tmp_path, target, input_files):
+        import os.path
+
+        queue_dir = str(tmp_path / 'queue')
+        results = target(
+            input_files, str(tmp_path / 'output'), queue_dir, poll=0.05,
+            idle=0.2)
+
+        assert set(error for _, _, error, _ in results) == {
+            'No worker claimed the unit in 0.2 seconds.'}
+        assert os.listdir(os.path.join(queue_dir, 'todo')) == []
+        assert os.path.exists(os.path.join(queue_dir, 'finished'))
+
+    def test_main_not_empty(self, tmp_path, capsys, input_files):
+        import os.path
+        from tbconv import distribute_main
+
+        queue = tmp_path / 'queue'
+        (queue / 'done').mkdir(parents=True)
+        (queue / 'done' / 'stray.json').write_text('')
+
+        assert distribute_main([
+            os.path.dirname(input_files[0]), str(tmp_path / 'output'),
+            str(queue), '--workers', '1']) == 1
+        assert 'Invalid work queue' in capsys.readouterr().out